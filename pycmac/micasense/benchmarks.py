@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+MicaSense Processing Benchmarks
+
+    Timing helpers for the MicaSense processing chain.
+
+    Synthetic RedEdge-like files can be generated with make_synthetic_flight so
+    the comparisons can be run without a real flight, e.g.
+
+        from pycmac.micasense import benchmarks
+        paths = benchmarks.make_synthetic_flight('/tmp/flight', captures=200)
+        print(benchmarks.compare_metadata_readers(paths))
+
+Copyright 2017 MicaSense, Inc.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in the
+Software without restriction, including without limitation the rights to use,
+copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+Software, and to permit persons to whom the Software is furnished to do so,
+subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+import os
+import math
+import time
+import tracemalloc
+import cv2
+import numpy as np
+
+import pycmac.micasense.metadata as metadata
+import pycmac.micasense.tiffmeta as tiffmeta
+import pycmac.micasense.image as image
+import pycmac.micasense.capture as capture
+import pycmac.micasense.imageutils as imageutils
+import pycmac.micasense.utils as utils
+
+_BANDS = [('Blue', 475, 32), ('Green', 560, 27), ('Red', 668, 14),
+          ('NIR', 842, 57), ('Red edge', 717, 12)]
+
+_XMP = '''<?xpacket begin="\ufeff" id="W5M0MpCehiHzreSzNTczkc9d"?>
+<x:xmpmeta xmlns:x="adobe:ns:meta/">
+ <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
+  <rdf:Description rdf:about=""
+    xmlns:MicaSense="http://micasense.com/MicaSense/1.0/"
+    xmlns:Camera="http://pix4d.com/camera/1.0/"
+    xmlns:DLS="http://micasense.com/DLS/1.0/"
+    MicaSense:CaptureId="{capture_id}"
+    MicaSense:FlightId="SyntheticFlight"
+    Camera:BandName="{band_name}"
+    Camera:CentralWavelength="{wavelength}"
+    Camera:WavelengthFWHM="{fwhm}"
+    Camera:RigCameraIndex="{band_index}"
+    Camera:RigRelatives="0.0,0.0,0.0"
+    Camera:PrincipalPoint="2.4,1.8"
+    Camera:PerspectiveFocalLength="5.4"
+    Camera:PerspectiveFocalLengthUnits="mm"
+    Camera:Irradiance="1.1"
+    Camera:Yaw="0.1"
+    Camera:Pitch="0.02"
+    Camera:Roll="-0.01"
+    DLS:SpectralIrradiance="1.1">
+   <MicaSense:RadiometricCalibration>
+    <rdf:Seq><rdf:li>0.00021</rdf:li><rdf:li>1.2e-07</rdf:li><rdf:li>1.9e-05</rdf:li></rdf:Seq>
+   </MicaSense:RadiometricCalibration>
+   <Camera:VignettingCenter>
+    <rdf:Seq><rdf:li>620.5</rdf:li><rdf:li>470.2</rdf:li></rdf:Seq>
+   </Camera:VignettingCenter>
+   <Camera:VignettingPolynomial>
+    <rdf:Seq><rdf:li>-1.1e-05</rdf:li><rdf:li>8.8e-07</rdf:li><rdf:li>-3.9e-09</rdf:li>
+     <rdf:li>6.6e-12</rdf:li><rdf:li>-5.4e-15</rdf:li><rdf:li>1.6e-18</rdf:li></rdf:Seq>
+   </Camera:VignettingPolynomial>
+   <Camera:PerspectiveDistortion>
+    <rdf:Seq><rdf:li>-0.1</rdf:li><rdf:li>0.2</rdf:li><rdf:li>-0.2</rdf:li>
+     <rdf:li>0.0001</rdf:li><rdf:li>-0.0002</rdf:li></rdf:Seq>
+   </Camera:PerspectiveDistortion>
+  </rdf:Description>
+ </rdf:RDF>
+</x:xmpmeta>
+<?xpacket end="w"?>'''
+
+
+def make_synthetic_flight(folder, captures=100, size=(1280, 960)):
+    """
+    Write a flight of RedEdge-like 5 band captures (IMG_XXXX_N.tif) carrying
+    the EXIF and XMP tags the micasense lib reads
+
+    Returns
+    -------
+
+    list of the written paths
+    """
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    width, height = size
+    rng = np.random.default_rng(0)
+    raw = rng.integers(4800, 40000, (height, width), dtype=np.uint16)
+    ifd0 = {271: (2, 'MicaSense'), 272: (2, 'RedEdge-M'), 305: (2, 'v5.1.7'),
+            50714: (3, (4800, 4800, 4800, 4800))}
+    gps = {1: (2, 'N'), 2: (5, ((55, 1), (51, 1), (3014, 100))),
+           3: (2, 'W'), 4: (5, ((4, 1), (17, 1), (1122, 100))),
+           5: (1, b'\x00'), 6: (5, ((11510, 100),))}
+    paths = []
+    for cap in range(captures):
+        exif = {33434: (5, ((1, 1000),)), 34867: (4, 100),
+                36867: (2, '2019:06:01 12:{:02d}:{:02d}'.format(cap // 60 % 60, cap % 60)),
+                37520: (2, '{:06d}'.format(cap * 37 % 1000000)),
+                37386: (5, ((54, 10),)), 41486: (5, ((26666, 100),)),
+                41487: (5, ((26666, 100),)), 41488: (3, 4),
+                42033: (2, 'RM01-1833069-SC')}
+        for band, (name, wl, fwhm) in enumerate(_BANDS):
+            xmp = _XMP.format(capture_id='synthetic{:06d}'.format(cap), band_name=name,
+                              wavelength=wl, fwhm=fwhm, band_index=band)
+            path = os.path.join(folder, 'IMG_{:04d}_{}.tif'.format(cap, band + 1))
+            tiffmeta.write_tiff(path, raw, ifd0=ifd0, exif=exif, gps=gps,
+                                xmp=xmp.encode('utf-8'))
+            paths.append(path)
+    return paths
+
+
+def metadata_reads_per_second(paths, native=False, repeats=1):
+    """ Time batched metadata extraction of paths, returning reads per second """
+    start = time.perf_counter()
+    for _ in range(repeats):
+        metadata.get_metadata_batch(paths, native=native, cache=False)
+    return len(paths) * repeats / (time.perf_counter() - start)
+
+
+def compare_metadata_readers(paths, repeats=1):
+    """
+    Metadata reads per second of the exiftool session and the native reader
+
+    Returns
+    -------
+
+    dict of {'exiftool': rate, 'native': rate}, exiftool is None when the
+    executable can not be started
+    """
+    rates = {'native': metadata_reads_per_second(paths, native=True, repeats=repeats)}
+    try:
+        rates['exiftool'] = metadata_reads_per_second(paths, repeats=repeats)
+    except (OSError, ValueError):
+        rates['exiftool'] = None
+    return rates
+
+
+def _legacy_reflectance(img, irradiance):
+    """ raw -> reflectance as Image computed it before the fused float32 path """
+    image_raw = np.copy(img.raw()).T
+    a1, a2, a3 = img.radiometric_cal[0], img.radiometric_cal[1], img.radiometric_cal[2]
+    v_poly_list = list(img.vignette_polynomial)
+    v_poly_list.reverse()
+    v_poly_list.append(1.)
+    x, y = np.meshgrid(np.arange(image_raw.shape[0]), np.arange(image_raw.shape[1]))
+    x = x.T
+    y = y.T
+    r = np.hypot((x-img.vignette_center[0]), (y-img.vignette_center[1]))
+    V = 1./np.polyval(np.array(v_poly_list), r)
+    R = 1.0 / (1.0 + a2 * y / img.exposure_time - a3 * y)
+    L = V * R * (image_raw - img.black_level)
+    L[L < 0] = 0
+    max_raw_dn = float(2**img.bits_per_pixel)
+    radiance_image = (L.astype(float)/(img.gain * img.exposure_time)*a1/max_raw_dn).T
+    return radiance_image * math.pi / irradiance
+
+
+def _profile(func, repeats):
+    func()  # warm up caches
+    tracemalloc.start()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        func()
+    elapsed = (time.perf_counter() - start) / repeats
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'seconds': elapsed, 'peak_mb': peak / 1e6}
+
+
+def compare_reflectance(path, irradiance=1.0, repeats=5, native=True):
+    """
+    Time and peak memory of one raw -> reflectance conversion of the image at
+    path, for the legacy float64 implementation and the fused kernel in
+    float32 and float64. The raw image is loaded beforehand.
+
+    Returns
+    -------
+
+    dict of {name: {'seconds': s, 'peak_mb': mb}}
+    """
+    img = image.Image(path, metadata.Metadata(path, native=native))
+    img.raw()
+    return {'legacy': _profile(lambda: _legacy_reflectance(img, irradiance), repeats),
+            'fused_float32': _profile(lambda: img.reflectance(irradiance, force_recompute=True,
+                                                             dtype=np.float32), repeats),
+            'fused_float64': _profile(lambda: img.reflectance(irradiance, force_recompute=True,
+                                                             dtype=np.float64), repeats)}
+
+
+def compare_aligned_capture(paths, irradiance=1.0, repeats=5, warp_matrices=None, native=True):
+    """
+    Time and peak memory of imageutils.aligned_capture of the capture made of
+    paths, resampling each band twice (undistort, then warp and crop) and once
+    through the fused registration maps. The maps are built by the warm up
+    call and both timings include the reflectance computation. warp_matrices
+    default to the identity.
+
+    Returns
+    -------
+
+    dict of {name: {'seconds': s, 'peak_mb': mb}}
+    """
+    cap = capture.Capture.from_filelist(paths, native=native)
+    irradiance_list = [irradiance] * len(cap.images)
+    if warp_matrices is None:
+        warp_matrices = [np.eye(3, dtype=np.float32) for _ in cap.images]
+    cap.compute_reflectance(irradiance_list)
+    crop, _ = imageutils.find_crop_bounds(cap, warp_matrices)
+
+    def aligned(fused):
+        # recomputing reflectance also drops the cached undistorted bands
+        cap.compute_reflectance(irradiance_list)
+        return imageutils.aligned_capture(cap, warp_matrices, cv2.MOTION_HOMOGRAPHY,
+                                          crop, None, fused=fused)
+
+    return {'two_pass': _profile(lambda: aligned(False), repeats),
+            'fused': _profile(lambda: aligned(True), repeats)}
+
+
+def _legacy_composites(cap, warp_matrices, crop):
+    """ RGB and RRENir uint16 composites as mspec built them before the buffer pool """
+    im_aligned = imageutils.aligned_capture(cap, warp_matrices, cv2.MOTION_HOMOGRAPHY, crop, None,
+                                            fused=False)
+    im_display = np.zeros((im_aligned.shape[0], im_aligned.shape[1], 5), dtype=np.float32)
+    for band in range(0, 5):
+        im_display[:, :, band] = imageutils.normalize(im_aligned[:, :, band]) * 32768
+    return [np.uint16(np.round(im_display[:, :, bands], decimals=0))
+            for bands in ([2, 1, 0], [4, 3, 2])]
+
+
+def compare_composites(paths, irradiance=1.0, repeats=5, warp_matrices=None, native=True):
+    """
+    Time and peak memory of building the RGB and RRENir composites of the
+    capture made of paths, undistorting and warping each band in two passes
+    and allocating every intermediate per capture (legacy), and with
+    imageutils.composites, the function mspec writes out, through a
+    utils.BufferPool whose buffers are released after each capture (pooled). Reflectance and the registration maps
+    are computed beforehand. warp_matrices default to the identity.
+
+    Returns
+    -------
+
+    dict of {name: {'seconds': s, 'peak_mb': mb}}, plus 'allocated', the
+    arrays the pool allocated over all the pooled runs
+    """
+    cap = capture.Capture.from_filelist(paths, native=native)
+    cap.compute_reflectance([irradiance] * len(cap.images))
+    if warp_matrices is None:
+        warp_matrices = [np.eye(3, dtype=np.float32) for _ in cap.images]
+    crop, _ = imageutils.find_crop_bounds(cap, warp_matrices)
+    pool = utils.BufferPool()
+
+    def pooled():
+        # imageutils.composites is what mspec._imgs_comp writes out
+        pool.release(*imageutils.composites(cap, warp_matrices, cv2.MOTION_HOMOGRAPHY, crop, None, pool))
+
+    return {'legacy': _profile(lambda: _legacy_composites(cap, warp_matrices, crop), repeats),
+            'pooled': _profile(pooled, repeats),
+            'allocated': pool.allocated}
@@ -28,14 +28,20 @@ IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 import pycmac.micasense.image as image
+import pycmac.micasense.metadata as metadata
 import pycmac.micasense.dls as dls
 import pycmac.micasense.plotutils as plotutils
 import pycmac.micasense.imageutils as imageutils
+import pycmac.micasense.utils as utils
 import math
 import numpy as np
 import cv2
 import os
 
+# attributes derived from the DLS pose and capture time
+_SUN_ATTRS = ('sun_vector_ned', 'sensor_vector_ned', 'sun_sensor_angle',
+              'solar_elevation', 'solar_azimuth', 'angular_correction')
+
 class Capture(object):
     """
     A capture is a set of images taken by one RedEdge cameras which share
@@ -43,7 +49,9 @@ class Capture(object):
     found in the same folder and also share the same filename prefix, such
     as IMG_0000_*.tif, but this is not required
     """
-    def __init__(self, images, panelCorners=[None]*5):
+    def __init__(self, images, panelCorners=[None]*5, lazy=False):
+        ''' If lazy is True the images are kept in the given order and neither the
+        capture ids nor the sun angles (and so no metadata) are evaluated until used '''
         if isinstance(images, image.Image):
             self.images = [images]
         elif isinstance(images, list):
@@ -51,15 +59,22 @@ class Capture(object):
         else:
             raise RuntimeError("Provide an image or list of images to create a Capture")
         self.num_bands = len(self.images)
-        self.images.sort()
-        capture_ids = [img.capture_id for img in self.images]
-        if len(set(capture_ids)) != 1:
-            raise RuntimeError("Images provided are required to all have the same capture id")
-        self.uuid = self.images[0].capture_id
         self.panels = None
         self.detected_panel_count = 0
         self.panelCorners = panelCorners
         self.dls_orientation_vector = np.array([0,0,-1])
+        if not lazy:
+            self.images.sort()
+            self.__set_uuid()
+            self.__compute_sun_angles()
+
+    def __set_uuid(self):
+        capture_ids = [img.capture_id for img in self.images]
+        if len(set(capture_ids)) != 1:
+            raise RuntimeError("Images provided are required to all have the same capture id")
+        self.uuid = self.images[0].capture_id
+
+    def __compute_sun_angles(self):
         self.sun_vector_ned, \
         self.sensor_vector_ned, \
         self.sun_sensor_angle, \
@@ -70,6 +85,16 @@ class Capture(object):
                                            self.dls_orientation_vector)
         self.angular_correction = dls.fresnel(self.sun_sensor_angle)
 
+    def __getattr__(self, name):
+        # only reached for attributes a lazy capture has not evaluated yet
+        if name == 'uuid':
+            self.__set_uuid()
+        elif name in _SUN_ATTRS:
+            self.__compute_sun_angles()
+        else:
+            raise AttributeError(name)
+        return self.__dict__[name]
+
     def set_panelCorners(self,panelCorners):
         self.panelCorners = panelCorners
         self.panels = None
@@ -89,13 +114,14 @@ class Capture(object):
         return cls(image.Image(file_name))
 
     @classmethod
-    def from_filelist(cls, file_list):
+    def from_filelist(cls, file_list, native=False, cache=None):
         if len(file_list) == 0:
             raise IOError("No files provided. Check your file paths")
         for fle in file_list:
             if not os.path.isfile(fle):
                 raise IOError("All files in file list must be a file. The following file is not:\nfle")
-        images = [image.Image(fle) for fle in file_list]
+        metas = metadata.Metadata.from_files(file_list, native=native, cache=cache)
+        images = [image.Image(fle, meta=m) for fle, m in zip(file_list, metas)]
         return cls(images)
 
     def __get_reference_index(self):
@@ -210,15 +236,18 @@ class Capture(object):
                     self.undistorted_reflectance(irradiance_list),
                     plot_type='Undistorted Reflectance')
 
-    def compute_radiance(self):
-        [img.radiance() for img in self.images]
+    def compute_radiance(self, n_jobs=None):
+        '''Compute image radiance, bands in parallel on n_jobs threads (see utils.map_bands)'''
+        utils.map_bands(lambda img: img.radiance(), self.images, n_jobs)
 
-    def compute_reflectance(self, irradiance_list=None, force_recompute=True):
-        '''Compute image reflectance from irradiance list, but don't return'''
+    def compute_reflectance(self, irradiance_list=None, force_recompute=True, n_jobs=None):
+        '''Compute image reflectance from irradiance list, but don't return
+        Bands are processed in parallel on n_jobs threads (see utils.map_bands)'''
         if irradiance_list is not None:
-            [img.reflectance(irradiance_list[i], force_recompute=force_recompute) for i,img in enumerate(self.images)]
+            utils.map_bands(lambda i: self.images[i].reflectance(irradiance_list[i], force_recompute=force_recompute),
+                            range(len(self.images)), n_jobs)
         else:
-            [img.reflectance(force_recompute=force_recompute) for img in self.images]
+            utils.map_bands(lambda img: img.reflectance(force_recompute=force_recompute), self.images, n_jobs)
 
     def eo_images(self):
         return [img for img in self.images if img.band_name != 'LWIR']
@@ -231,10 +260,13 @@ class Capture(object):
         lw_imgs = [img.reflectance() for i,img in enumerate(self.lw_images())]
         return eo_imgs + lw_imgs
 
-    def undistorted_reflectance(self, irradiance_list):
-        '''Comptute and return list of reflectance images for given irradiance'''
-        eo_imgs = [img.undistorted(img.reflectance(irradiance_list[i])) for i,img in enumerate(self.eo_images())]
-        lw_imgs = [img.undistorted(img.reflectance()) for i,img in enumerate(self.lw_images())]
+    def undistorted_reflectance(self, irradiance_list, n_jobs=None):
+        '''Comptute and return list of reflectance images for given irradiance
+        Bands are processed in parallel on n_jobs threads (see utils.map_bands)'''
+        eo = self.eo_images()
+        eo_imgs = utils.map_bands(lambda i: eo[i].undistorted(eo[i].reflectance(irradiance_list[i])),
+                                  range(len(eo)), n_jobs)
+        lw_imgs = utils.map_bands(lambda img: img.undistorted(img.reflectance()), self.lw_images(), n_jobs)
         return eo_imgs + lw_imgs
 
     def panels_in_all_expected_images(self):
@@ -329,8 +361,10 @@ class Capture(object):
         return [w/w[2,2] for w in warp_matrices]
 
 
-    def save_capture_as_reflectance_stack(self, outfilename, irradiance_list=None, warp_matrices=None, normalize = False):
-        from osgeo.gdal import GetDriverByName, GDT_UInt16
+    def save_capture_as_reflectance_stack(self, outfilename, irradiance_list=None, warp_matrices=None, normalize = False, tags_from=None):
+        ''' Write the aligned reflectance bands as a uint16 (0-32768) TIFF stack in a
+        single pass, embedding the EXIF, GPS and XMP tags of tags_from (default
+        the first band's image), see metadata.write_tagged '''
         self.compute_reflectance(irradiance_list)
         if warp_matrices is None:
             warp_matrices = self.get_warp_matrices()
@@ -338,23 +372,18 @@ class Capture(object):
         im_aligned = imageutils.aligned_capture(self, warp_matrices, cv2.MOTION_HOMOGRAPHY, cropped_dimensions, None, img_type="reflectance")
 
         rows, cols, bands = im_aligned.shape
-        driver = GetDriverByName('GTiff')
-        outRaster = driver.Create(outfilename, cols, rows, bands, GDT_UInt16)
-        if outRaster is None:
-            raise IOError("could not load gdal GeoTiff driver")
+        stack = np.empty((rows, cols, bands), dtype=np.uint16)
         for i in range(0,5):
-            outband = outRaster.GetRasterBand(i+1)
             outdata = im_aligned[:,:,i]
-            outdata[outdata<0] = 0
-            outdata[outdata>1] = 1
-            outband.WriteArray(outdata*32768)
-            outband.FlushCache()
+            np.clip(outdata, 0, 1, out=outdata)
+            outdata *= 32768
+            stack[:,:,i] = np.rint(outdata, out=outdata)
 
         if bands == 6:
-            outband = outRaster.GetRasterBand(6)
             outdata = (im_aligned[:,:,5]+273.15) * 100 # scale data from float degC to back to centi-Kelvin to fit into uint16
-            outdata[outdata<0] = 0
-            outdata[outdata>65535] = 65535
-            outband.WriteArray(outdata)
-            outband.FlushCache()
-        outRaster = None
+            np.clip(outdata, 0, 65535, out=outdata)
+            stack[:,:,5] = np.rint(outdata, out=outdata)
+
+        if tags_from is None:
+            tags_from = self.images[0].path
+        metadata.write_tagged(outfilename, stack, tags_from)
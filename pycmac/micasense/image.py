@@ -29,11 +29,38 @@ CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 import os
 import cv2
 import math
+import weakref
+import itertools
 import numpy as np
 
 import matplotlib.pyplot as plt
 import pycmac.micasense.plotutils as plotutils
 import pycmac.micasense.metadata as metadata
+import pycmac.micasense.utils as utils
+
+# dtype of computed intensity, radiance and reflectance images unless asked otherwise
+DEFAULT_DTYPE = np.float32
+
+# raw and derived pixel products of every Image in this process share one LRU
+# cache, keyed by (image token, product, parameters) and bounded in bytes
+PRODUCT_CACHE_MB = float(os.environ.get('PYCMAC_CACHE_MB', 2048))
+_products = utils.LRUCache(max_bytes=int(PRODUCT_CACHE_MB * 2**20))
+_tokens = itertools.count()
+
+def set_product_cache_budget(megabytes):
+    ''' Set the per-process memory ceiling of cached image products, None for unbounded '''
+    _products.resize(max_bytes=None if megabytes is None else int(megabytes * 2**20))
+
+def product_cache_budget():
+    ''' Per-process ceiling in bytes of cached image products, None if unbounded '''
+    return _products.max_bytes
+
+def product_cache_bytes():
+    ''' Bytes currently held by cached image products in this process '''
+    return _products.nbytes
+
+def _release_products(token):
+    _products.pop_matching(lambda key: key[0] == token)
 
 #helper function to convert euler angles to a rotation matrix
 def rotations_degrees_to_rotation_matrix(rotation_degrees):
@@ -44,81 +71,179 @@ def rotations_degrees_to_rotation_matrix(rotation_degrees):
    sy = np.sin(np.deg2rad(rotation_degrees[1]))
    sz = np.sin(np.deg2rad(rotation_degrees[2]))
 
-   Rx = np.mat([  1,  0,  0,
+   Rx = np.asmatrix([  1,  0,  0,
                   0, cx,-sx,
                   0, sx, cx]).reshape(3,3)
-   Ry = np.mat([ cy,  0, sy,
+   Ry = np.asmatrix([ cy,  0, sy,
                   0,  1,  0,
                 -sy,  0, cy]).reshape(3,3)
-   Rz = np.mat([ cz,-sz,  0,
+   Rz = np.asmatrix([ cz,-sz,  0,
                  sz, cz,  0,
                   0,  0,  1]).reshape(3,3)
    R = Rx*Ry*Rz
    return R
 
+# Image attribute -> (Metadata accessor, index into its result), filled on first access
+_META_ATTRS = {
+    'utc_time': ('utc_time', None),
+    'latitude': ('position', 0),
+    'longitude': ('position', 1),
+    'altitude': ('position', 2),
+    'dls_present': ('dls_present', None),
+    'dls_yaw': ('dls_pose', 0),
+    'dls_pitch': ('dls_pose', 1),
+    'dls_roll': ('dls_pose', 2),
+    'dls_irradiance': ('dls_irradiance', None),
+    'capture_id': ('capture_id', None),
+    'flight_id': ('flight_id', None),
+    'band_name': ('band_name', None),
+    'band_index': ('band_index', None),
+    'black_level': ('black_level', None),
+    'radiometric_cal': ('radiometric_cal', None),
+    'exposure_time': ('exposure', None),
+    'gain': ('gain', None),
+    'bits_per_pixel': ('bits_per_pixel', None),
+    'vignette_center': ('vignette_center', None),
+    'vignette_polynomial': ('vignette_polynomial', None),
+    'distortion_parameters': ('distortion_parameters', None),
+    'principal_point': ('principal_point', None),
+    'focal_plane_resolution_px_per_mm': ('focal_plane_resolution_px_per_mm', None),
+    'focal_length': ('focal_length_mm', None),
+    'center_wavelength': ('center_wavelength', None),
+    'bandwidth': ('bandwidth', None),
+    'rig_relatives': ('rig_relatives', None),
+    'spectral_irradiance': ('spectral_irradiance', None),
+    'horizontal_irradiance': ('horizontal_irradiance', None),
+    'scattered_irradiance': ('scattered_irradiance', None),
+    'direct_irradiance': ('direct_irradiance', None),
+    'solar_azimuth': ('solar_azimuth', None),
+    'solar_elevation': ('solar_elevation', None),
+    'estimated_direct_vector': ('estimated_direct_vector', None),
+    'auto_calibration_image': ('auto_calibration_image', None),
+    'panel_albedo': ('panel_albedo', None),
+    'panel_region': ('panel_region', None),
+    'panel_serial': ('panel_serial', None),
+}
+
 class Image(object):
     """
     An Image is a single file taken by a RedEdge camera representing one
     band of multispectral information
+
+    Images are slotted and their metadata derived attributes are only
+    computed when first used, so large ImageSets stay small in memory and
+    cheap to pass between processes.
+
+    Raw and derived pixel products are kept in the process wide product
+    cache (see set_product_cache_budget) rather than on the Image, and are
+    not pickled with it.
     """
-    def __init__(self, image_path):
+    __slots__ = ('path', 'meta', 'rig_translations', '_meta_options',
+                 '_token', '_finalizer', '_product_keys', '_reflectance_irradiance',
+                 '__weakref__') + tuple(_META_ATTRS)
+
+    def __init__(self, image_path, meta=None, lazy=False, native=False, cache=None):
+        ''' If lazy is True and no meta is given, metadata is only read (with the
+        native and cache options of metadata.Metadata) when first needed '''
         if not os.path.isfile(image_path):
             raise IOError("Provided path is not a file: {}".format(image_path))
         self.path = image_path
-        self.meta = metadata.Metadata(self.path)
+        self._reflectance_irradiance = None # irradiance of the last reflectance
+
+        if meta is None and lazy:
+            self._meta_options = (native, cache)
+            return
+        if meta is None:
+            meta = metadata.Metadata(self.path, native=native, cache=cache)
+        self.__set_meta(meta)
+
+    def __set_meta(self, meta):
+        self.meta = meta.compact()
 
         if self.meta.band_name() is None:
-            raise ValueError("Provided file path does not have a band name: {}".format(image_path))
+            raise ValueError("Provided file path does not have a band name: {}".format(self.path))
         if self.meta.band_name().upper() != 'LWIR' and not self.meta.supports_radiometric_calibration():
             raise ValueError('Library requires images taken with camera firmware v2.1.0 or later. ' +
             'Upgrade your camera firmware to use this library.')
 
-        self.utc_time = self.meta.utc_time()
-        self.latitude, self.longitude, self.altitude = self.meta.position()
-        self.dls_present = self.meta.dls_present()
-        self.dls_yaw, self.dls_pitch, self.dls_roll = self.meta.dls_pose()
-        self.dls_irradiance = self.meta.dls_irradiance()
-        self.capture_id = self.meta.capture_id()
-        self.flight_id = self.meta.flight_id()
-        self.band_name = self.meta.band_name()
-        self.band_index = self.meta.band_index()
-        self.black_level = self.meta.black_level()
-        if self.meta.supports_radiometric_calibration():
-            self.radiometric_cal = self.meta.radiometric_cal()
-        self.exposure_time = self.meta.exposure()
-        self.gain = self.meta.gain()
-        self.bits_per_pixel = self.meta.bits_per_pixel()
-        self.vignette_center = self.meta.vignette_center()
-        self.vignette_polynomial = self.meta.vignette_polynomial()
-        self.distortion_parameters = self.meta.distortion_parameters()
-        self.principal_point = self.meta.principal_point()
-        self.focal_plane_resolution_px_per_mm = self.meta.focal_plane_resolution_px_per_mm()
-        self.focal_length = self.meta.focal_length_mm()
-        self.center_wavelength = self.meta.center_wavelength()
-        self.bandwidth = self.meta.bandwidth()
-        self.rig_relatives = self.meta.rig_relatives()
-        self.spectral_irradiance = self.meta.spectral_irradiance()
-        self.horizontal_irradiance = self.meta.horizontal_irradiance()
-        self.scattered_irradiance = self.meta.scattered_irradiance()
-        self.direct_irradiance = self.meta.direct_irradiance()
-        self.solar_azimuth = self.meta.solar_azimuth()
-        self.solar_elevation = self.meta.solar_elevation()
-        self.estimated_direct_vector = self.meta.estimated_direct_vector()
-        self.auto_calibration_image = self.meta.auto_calibration_image()
-        self.panel_albedo = self.meta.panel_albedo()
-        self.panel_region = self.meta.panel_region()
-        self.panel_serial = self.meta.panel_serial()
-        
         if self.bits_per_pixel != 16:
             NotImplemented("Unsupported pixel bit depth: {} bits".format(self.bits_per_pixel))
 
-        self.__raw_image = None # pure raw pixels
-        self.__intensity_image = None # black level and gain-exposure/radiometric compensated
-        self.__radiance_image = None # calibrated to radiance
-        self.__reflectance_image = None # calibrated to reflectance (0-1)
-        self.__reflectance_irradiance = None
-        self.__undistorted_source = None # can be any of raw, intensity, radiance
-        self.__undistorted_image = None # current undistorted image, depdining on source
+    def pending_meta(self):
+        ''' (native, cache) options of a lazy image whose metadata is not read yet, else None '''
+        try:
+            object.__getattribute__(self, 'meta')
+        except AttributeError:
+            return self._meta_options
+        return None
+
+    def set_meta(self, meta):
+        ''' Give a lazy image metadata read elsewhere, e.g. in a batch '''
+        self.__set_meta(meta)
+
+    def __getattr__(self, name):
+        # only reached for unset slots: fill metadata attributes on first access
+        if name == 'meta':
+            native, cache = self._meta_options
+            self.__set_meta(metadata.Metadata(self.path, native=native, cache=cache))
+            return self.meta
+        if name == '_token':
+            # identifies this Image's entries in the product cache, which are
+            # dropped when it is garbage collected
+            self._token = next(_tokens)
+            self._finalizer = weakref.finalize(self, _release_products, self._token)
+            self._finalizer.atexit = False
+            return self._token
+        if name == '_product_keys':
+            # id of each product array stored by this Image -> its cache key
+            self._product_keys = {}
+            return self._product_keys
+        try:
+            method, index = _META_ATTRS[name]
+        except KeyError:
+            raise AttributeError(name)
+        value = getattr(self.meta, method)()
+        if index is not None:
+            value = value[index]
+        setattr(self, name, value)
+        return value
+
+    def __getstate__(self):
+        state = {}
+        for name in self.__slots__:
+            if name in ('_token', '_finalizer', '_product_keys', '_reflectance_irradiance', '__weakref__'):
+                continue
+            try:
+                state[name] = object.__getattribute__(self, name)
+            except AttributeError:
+                pass
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+        self._reflectance_irradiance = None
+
+    def __product(self, key):
+        return _products.get((self._token,) + key)
+
+    def __store(self, key, value):
+        # anything undistorted from a product being replaced is stale
+        token = self._token
+        _products.pop_matching(lambda k: k[0] == token and k[1] == 'undistorted' and k[2] == key)
+        keys = self._product_keys
+        for stale in [i for i, k in keys.items() if k == key]:
+            del keys[stale]
+        keys[id(value)] = key
+        return _products.put((token,) + key, value)
+
+    def __product_key(self, array):
+        ''' Key of the cached product which is array, None if it is not one '''
+        key = self._product_keys.get(id(array))
+        # the id may be of an evicted product whose memory has been reused
+        if key is None or _products.get((self._token,) + key) is not array:
+            return None
+        return key
 
     def __lt__(self, other):
         return self.band_index < other.band_index
@@ -136,13 +261,14 @@ class Image(object):
 
     def raw(self):
         ''' Lazy load the raw image once neecessary '''
-        if self.__raw_image is None:
+        raw_image = self.__product(('raw',))
+        if raw_image is None:
             try:
-                self.__raw_image = cv2.imread(self.path,-1)
+                raw_image = self.__store(('raw',), cv2.imread(self.path,-1))
             except IOError:
                 print("Could not open image at path {}".format(self.path))
                 raise
-        return self.__raw_image
+        return raw_image
 
     def set_external_rig_relatives(self,external_rig_relatives):
         self.rig_translations = external_rig_relatives['rig_translations']
@@ -154,107 +280,110 @@ class Image(object):
         ry = self.focal_plane_resolution_px_per_mm[1]
         self.principal_point = [px/rx,py/ry]
         self.focal_length = (fx+fy)*.5/rx
+        token = self._token
+        _products.pop_matching(lambda key: key[0] == token and key[1] == 'undistorted')
         #to do - set the distortion etc.
 
     def clear_image_data(self):
         ''' clear all computed images to reduce memory overhead '''
-        self.__raw_image = None
-        self.__intensity_image = None
-        self.__radiance_image = None
-        self.__reflectance_image = None
-        self.__reflectance_irradiance = None
-        self.__undistorted_source = None
-        self.__undistorted_image = None
+        _release_products(self._token)
+        self._product_keys.clear()
+        self._reflectance_irradiance = None
 
     def size(self):
         width, height = self.meta.image_size()
         return width, height
 
-    def reflectance(self, irradiance=None, force_recompute=False):
-        ''' Lazy-compute and return a reflectance image provided an irradiance reference '''
-        if self.__reflectance_image is not None \
-            and force_recompute == False \
-            and (self.__reflectance_irradiance == irradiance or irradiance == None):
-            return self.__reflectance_image
+    def reflectance(self, irradiance=None, force_recompute=False, dtype=None):
+        ''' Lazy-compute and return a reflectance image provided an irradiance reference
+        If the radiance is not already computed in the same dtype (default
+        DEFAULT_DTYPE), reflectance is computed straight from the raw image
+        without keeping a radiance image '''
+        dtype = np.dtype(DEFAULT_DTYPE if dtype is None else dtype)
+        if irradiance is None:
+            irradiance = self._reflectance_irradiance
         if irradiance is None and self.band_name != 'LWIR':
             if self.horizontal_irradiance != 0.0:
                 irradiance = self.horizontal_irradiance
             else:
                 raise RuntimeError("Provide a band-specific spectral irradiance to compute reflectance")
+        key = ('reflectance', irradiance, dtype.str)
+        if not force_recompute:
+            reflectance_image = self.__product(key)
+            if reflectance_image is not None:
+                return reflectance_image
+        self._reflectance_irradiance = irradiance
         if self.band_name != 'LWIR':
-            self.__reflectance_irradiance = irradiance
-            self.__reflectance_image = self.radiance() * math.pi / irradiance
+            radiance = None if force_recompute else self.__product(('radiance', dtype.str))
+            if radiance is not None:
+                reflectance_image = radiance * dtype.type(math.pi / irradiance)
+            else:
+                reflectance_image = self.__corrected(self.radiance_scale() * math.pi / irradiance, dtype)
         else:
-            self.__reflectance_image = self.radiance()
-        return self.__reflectance_image
+            return self.radiance(dtype=dtype)
+        return self.__store(key, reflectance_image)
 
-    def intensity(self, force_recompute=False):
+    def intensity(self, force_recompute=False, dtype=None):
         ''' Lazy=computes and returns the intensity image after black level,
             vignette, and row correction applied.
             Intensity is in units of DN*Seconds without a radiance correction '''
-        if self.__intensity_image is not None and force_recompute == False:
-            return self.__intensity_image
-
-        # get image dimensions
-        image_raw = np.copy(self.raw()).T
-
-        #  get radiometric calibration factors
-        _, a2, a3 = self.radiometric_cal[0], self.radiometric_cal[1], self.radiometric_cal[2]
+        dtype = np.dtype(DEFAULT_DTYPE if dtype is None else dtype)
+        key = ('intensity', dtype.str)
+        if not force_recompute:
+            intensity_image = self.__product(key)
+            if intensity_image is not None:
+                return intensity_image
 
-        # apply image correction methods to raw image
-        V, x, y = self.vignette()
-        R = 1.0 / (1.0 + a2 * y / self.exposure_time - a3 * y)
-        L = V * R * (image_raw - self.black_level)
-        L[L < 0] = 0
         max_raw_dn = float(2**self.bits_per_pixel)
-        intensity_image = L.astype(float)/(self.gain * self.exposure_time * max_raw_dn)
+        return self.__store(key, self.__corrected(1.0 / (self.gain * self.exposure_time * max_raw_dn), dtype))
 
-        self.__intensity_image = intensity_image.T
-        return self.__intensity_image
-
-    def radiance(self, force_recompute=False):
+    def radiance(self, force_recompute=False, dtype=None):
         ''' Lazy=computes and returns the radiance image after all radiometric
-        corrections have been applied '''
-        if self.__radiance_image is not None and force_recompute == False:
-            return self.__radiance_image
-
-        # get image dimensions
-        image_raw = np.copy(self.raw()).T
+        corrections have been applied, as dtype (default DEFAULT_DTYPE) '''
+        dtype = np.dtype(DEFAULT_DTYPE if dtype is None else dtype)
+        key = ('radiance', dtype.str)
+        if not force_recompute:
+            radiance_image = self.__product(key)
+            if radiance_image is not None:
+                return radiance_image
 
         if(self.band_name != 'LWIR'):
-            #  get radiometric calibration factors
-            a1, a2, a3 = self.radiometric_cal[0], self.radiometric_cal[1], self.radiometric_cal[2]
-            # apply image correction methods to raw image
-            V, x, y = self.vignette()
-            R = 1.0 / (1.0 + a2 * y / self.exposure_time - a3 * y)
-            L = V * R * (image_raw - self.black_level)
-            L[L < 0] = 0
-            max_raw_dn = float(2**self.bits_per_pixel)
-            radiance_image = L.astype(float)/(self.gain * self.exposure_time)*a1/max_raw_dn
+            radiance_image = self.__corrected(self.radiance_scale(), dtype)
         else:
-            L = image_raw - (273.15*100.0) # convert to C from K
-            radiance_image = L.astype(float) * 0.01
-        self.__radiance_image = radiance_image.T
-        return self.__radiance_image
+            # convert to C from centi-K
+            radiance_image = np.subtract(self.raw(), 273.15*100.0, dtype=dtype)
+            radiance_image *= 0.01
+        return self.__store(key, radiance_image)
+
+    def radiance_scale(self):
+        ''' Factor taking black level, vignette and row corrected DN to radiance '''
+        max_raw_dn = float(2**self.bits_per_pixel)
+        return self.radiometric_cal[0] / (self.gain * self.exposure_time * max_raw_dn)
+
+    def __corrected(self, scale, dtype):
+        ''' (raw - black level) * correction map * scale, floored at 0, computed
+        in place in a single dtype array '''
+        out = np.subtract(self.raw(), self.black_level, dtype=dtype)
+        np.multiply(out, self.correction_map(), out=out)
+        np.maximum(out, 0, out=out)
+        out *= dtype.type(scale)
+        return out
+
+    def correction_map(self):
+        ''' The combined vignette and row gradient correction of this image, in
+        image orientation. The map is shared by all images of the band taken
+        with the same exposure, see utils.correction_map '''
+        _, a2, a3 = self.radiometric_cal[0], self.radiometric_cal[1], self.radiometric_cal[2]
+        return utils.correction_map(self.vignette_center, self.vignette_polynomial,
+                                    a2, a3, self.exposure_time, self.raw().shape,
+                                    band=self.band_index)
 
     def vignette(self):
         ''' Get a numpy array which defines the value to multiply each pixel by to correct
         for optical vignetting effects.
         Note: this array is transposed from normal image orientation and comes as part
-        of a three-tuple, the other parts of which are also used by the radiance method.
+        of a three-tuple, the other parts of which are the transposed pixel coordinates.
         '''
-        # get vignette center
-        vignette_center_x, vignette_center_y = self.vignette_center
-
-        # get a copy of the vignette polynomial because we want to modify it here
-        v_poly_list = list(self.vignette_polynomial)
-
-        # reverse list and append 1., so that we can call with numpy polyval
-        v_poly_list.reverse()
-        v_poly_list.append(1.)
-        v_polynomial = np.array(v_poly_list)
-
-        # perform vignette correction
         # get coordinate grid across image, seem swapped because of transposed vignette
         x_dim, y_dim = self.raw().shape[1], self.raw().shape[0]
         x, y = np.meshgrid(np.arange(x_dim), np.arange(y_dim))
@@ -263,12 +392,9 @@ class Image(object):
         x = x.T
         y = y.T
 
-        # compute matrix of distances from image center
-        r = np.hypot((x-vignette_center_x), (y-vignette_center_y))
-
-        # compute the vignette polynomial for each distance - we divide by the polynomial so that the
-        # corrected image is image_corrected = image_original * vignetteCorrection
-        vignette = 1./np.polyval(v_polynomial, r)
+        # the cached vignette map is in image orientation
+        vignette = utils.vignette_array(self.vignette_center, self.vignette_polynomial,
+                                        (y_dim, x_dim)).T
         return vignette, x, y
 
     def undistorted_radiance(self, force_recompute=False):
@@ -313,28 +439,30 @@ class Image(object):
         t_y = math.radians(self.rig_relatives[1]) / px_fov_y
         return (t_x, t_y)
 
-    def undistorted(self, image):
-        ''' return the undistorted image from input image '''
-        # If we have already undistorted the same source, just return that here
-        # otherwise, lazy compute the undstorted image
-        if self.__undistorted_source is not None and image.data == self.__undistorted_source.data:
-            return self.__undistorted_image
-
-        self.__undistorted_source = image
-
-        new_cam_mat, _ = cv2.getOptimalNewCameraMatrix(self.cv2_camera_matrix(),
-                                                       self.cv2_distortion_coeff(),
-                                                       self.size(),
-                                                       1)
-        map1, map2 = cv2.initUndistortRectifyMap(self.cv2_camera_matrix(),
-                                                self.cv2_distortion_coeff(),
-                                                np.eye(3),
-                                                new_cam_mat,
-                                                self.size(),
-                                                cv2.CV_32F) # cv2.CV_32F for 32 bit floats
+    def undistorted(self, image, fixed_point=None):
+        ''' return the undistorted image from input image
+        The remap tables are shared by all images with the same intrinsics,
+        see utils.undistort_maps for fixed_point.
+        Undistorting one of this image's own products (raw(), radiance(), ...)
+        is cached against that product, other arrays are always remapped '''
+        if fixed_point is None:
+            fixed_point = utils.FIXED_POINT_REMAP
+        source = self.__product_key(image)
+        if source is not None:
+            key = ('undistorted', source, fixed_point)
+            undistorted_image = self.__product(key)
+            if undistorted_image is not None:
+                return undistorted_image
+
+        map1, map2 = utils.undistort_maps(self.cv2_camera_matrix(),
+                                          self.cv2_distortion_coeff(),
+                                          self.size(),
+                                          fixed_point)
         # compute the undistorted 16 bit image
-        self.__undistorted_image = cv2.remap(image, map1, map2, cv2.INTER_LINEAR)
-        return self.__undistorted_image
+        undistorted_image = cv2.remap(image, map1, map2, cv2.INTER_LINEAR)
+        if source is not None:
+            _products.put((self._token,) + key, undistorted_image)
+        return undistorted_image
 
     def plot_raw(self, title=None, figsize=None):
         ''' Create a single plot of the raw image '''
@@ -387,12 +515,12 @@ class Image(object):
         A[0:3,0:3]=R
         A[0:3,3]=T
         A[3,3]=1.
-        C, _ = cv2.getOptimalNewCameraMatrix(self.cv2_camera_matrix(),
-                                             self.cv2_distortion_coeff(),
-                                             self.size(),1)
-        Cr, _ = cv2.getOptimalNewCameraMatrix(ref.cv2_camera_matrix(),
-                                              ref.cv2_distortion_coeff(),
-                                              ref.size(),1)
+        C = utils.optimal_camera_matrix(self.cv2_camera_matrix(),
+                                        self.cv2_distortion_coeff(),
+                                        self.size())
+        Cr = utils.optimal_camera_matrix(ref.cv2_camera_matrix(),
+                                         ref.cv2_distortion_coeff(),
+                                         ref.size())
         CC = np.zeros((4,4))
         CC[0:3,0:3] = C
         CC[3,3]=1.
@@ -27,41 +27,122 @@ COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
 IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
-import os, glob, fnmatch
+import os, glob, fnmatch, re, time
+from functools import partial
 import pycmac.micasense.image as image
 import pycmac.micasense.capture as capture
+import pycmac.micasense.metadata as metadata
+import pycmac.micasense.utils as utils
 import multiprocessing
+import numpy as np
+import pytz
 
 def image_from_file(filename):
     return image.Image(filename)
 
+def images_from_files(filenames, native=False):
+    ''' Build the images of a chunk of files with one batched metadata read,
+    reusing the exiftool process of the calling worker '''
+    metas = metadata.Metadata.from_files(filenames, native=native)
+    return [image.Image(f, meta=m) for f, m in zip(filenames, metas)]
+
+# MicaSense file naming, IMG_<capture number>_<band number>.tif
+CAPTURE_FILE = re.compile(r'^(IMG_\d+)_(\d+)\.tif$', re.IGNORECASE)
+
+def scan_capture_files(directory):
+    ''' Recursively group the MicaSense files below directory by name.
+    Returns {(folder, 'IMG_XXXX'): [path of band 1, band 2, ...]}, with
+    the groups and their bands in name order '''
+    groups = {}
+    folders = [directory]
+    while folders:
+        folder = folders.pop()
+        with os.scandir(folder) as it:
+            for entry in it:
+                if entry.is_dir():
+                    folders.append(entry.path)
+                    continue
+                m = CAPTURE_FILE.match(entry.name)
+                if m is not None:
+                    groups.setdefault((folder, m.group(1)), []).append((int(m.group(2)), entry.path))
+    return dict((key, [p for _, p in sorted(groups[key])]) for key in sorted(groups))
+
+def released(batches):
+    """
+    Yield each list of captures from batches, clearing the pixel data of a
+    list (see Capture.clear_image_data) once the consumer asks for the next
+    one or stops iterating
+    """
+    batch = []
+    try:
+        for batch in batches:
+            yield batch
+            for cap in batch:
+                cap.clear_image_data()
+            batch = []
+    finally:
+        for cap in batch:
+            cap.clear_image_data()
+
 class ImageSet(object):
     """
     An ImageSet is a container for a group of captures that are processed together
     """
-    def __init__(self, captures):
+    def __init__(self, captures, sort=True):
         self.captures = captures
-        captures.sort()
+        if sort:
+            captures.sort()
         
     @classmethod
-    def from_directory(cls, directory, progress_callback=None):
+    def from_directory(cls, directory, progress_callback=None, native=False, cache=None, lazy=False):
         """
         Create and ImageSet recursively from the files in a directory
+        
+        If native is True metadata is read in-process by tiffmeta rather than by exiftool.
+        cache (see metadata.metadata_cache, off unless given or $PYCMAC_METADATA_CACHE
+        is set) holds previously extracted metadata, only new or modified files are
+        read again.
+
+        If lazy is True captures are grouped by file name (IMG_XXXX_N.tif, other
+        files are ignored) and ordered by folder and capture number; the images
+        only read their metadata once one of their attributes is used.
         """
         cls.basedir = directory
+        if lazy:
+            store = metadata.metadata_cache(cache)
+            captures = [capture.Capture([image.Image(p, lazy=True, native=native, cache=store) for p in paths],
+                                        lazy=True)
+                        for paths in scan_capture_files(directory).values()]
+            if progress_callback is not None:
+                progress_callback(1.0)
+            return cls(captures, sort=False)
         matches = []
         for root, dirnames, filenames in os.walk(directory):
             for filename in fnmatch.filter(filenames, '*.tif'):
                 matches.append(os.path.join(root, filename))
 
-        pool = multiprocessing.Pool(processes=multiprocessing.cpu_count())
-        images = []
-        for i,img in enumerate(pool.imap_unordered(image_from_file, matches)):
-            images.append(img)
-            if progress_callback is not None:
-                progress_callback(float(i)/float(len(matches)))
-        pool.close() 
-        pool.join()
+        # cache lookups and writes stay in this process, workers only extract
+        store = metadata.metadata_cache(cache)
+        cached = store.get_many(matches, native) if store is not None else {}
+        images = [image.Image(p, meta=metadata.Metadata(p, exif=cached[p])) for p in matches if p in cached]
+        todo = [p for p in matches if p not in cached]
+
+        # a worker is mostly its interpreter and exiftool process
+        nproc = utils.auto_workers(64 * 2**20)
+        # a few chunks per worker keeps the pool balanced while each worker
+        # keeps a single exiftool process alive across all of its chunks
+        chunk_size = max(1, min(256, len(todo) // (nproc * 4) + 1))
+        chunks = [todo[i:i+chunk_size] for i in range(0, len(todo), chunk_size)]
+        if chunks:
+            pool = multiprocessing.Pool(processes=nproc)
+            for imgs in pool.imap_unordered(partial(images_from_files, native=native), chunks):
+                images.extend(imgs)
+                if store is not None:
+                    store.put_many([img.path for img in imgs], [img.meta.exif for img in imgs], native)
+                if progress_callback is not None:
+                    progress_callback(float(len(images))/float(len(matches)))
+            pool.close() 
+            pool.join()
         # create a dictionary to index the images so we can sort them
         # into captures
         # {
@@ -83,28 +164,223 @@ class ImageSet(object):
             progress_callback(1.0)
         return cls(captures)
     
+    def update(self, directory=None, num_bands=None, settle=2.0, native=False, cache=None):
+        """
+        Incrementally add the captures that appeared (or changed) in directory
+        since the last call, e.g. while a flight is still being copied off the card.
+        
+        Only complete captures are added: all num_bands files present, each
+        unmodified for settle seconds and with readable metadata. Anything else
+        is retried on the next call. num_bands defaults to the band count of the
+        captures already held and must be given while there are none, as files
+        arriving one by one can not tell a partial capture from a complete one.
+        
+        Returns
+        -------
+        
+        list of the captures added or replaced by this call, in capture order
+        """
+        if directory is None:
+            directory = self.basedir
+        self.basedir = directory
+        if getattr(self, '_stamps', None) is None:
+            # files of captures we already hold -> (size, mtime)
+            self._stamps = {}
+            for cap in self.captures:
+                for img in cap.images:
+                    st = os.stat(img.path)
+                    self._stamps[img.path] = (st.st_size, st.st_mtime_ns)
+        if num_bands is None:
+            if not self.captures:
+                raise ValueError("num_bands is required until the ImageSet holds a capture")
+            num_bands = len(self.captures[0].images)
+        groups = scan_capture_files(directory)
+        held = dict((img.path, cap) for cap in self.captures for img in cap.images)
+        store = metadata.metadata_cache(cache)
+        now = time.time()
+        added = []
+        for paths in groups.values():
+            if len(paths) < num_bands:
+                continue
+            stats = [os.stat(p) for p in paths]
+            stamps = [(st.st_size, st.st_mtime_ns) for st in stats]
+            if all(self._stamps.get(p) == stamp for p, stamp in zip(paths, stamps)):
+                continue
+            if any(now - st.st_mtime < settle for st in stats):
+                continue
+            try:
+                cap = capture.Capture.from_filelist(paths, native=native, cache=store)
+            except Exception:
+                # partially copied files fail in many ways, retry them on the next scan
+                continue
+            old = held.get(paths[0])
+            if old is not None:
+                self.captures.remove(old)
+            self.captures.append(cap)
+            self._stamps.update(zip(paths, stamps))
+            added.append(cap)
+        if added:
+            self.captures.sort()
+            added.sort()
+            self._index = None
+        return added
+
+    def iter_captures(self, chunk_size=64, release=True):
+        """
+        Generator yielding the captures in lists of up to chunk_size, so a
+        flight can be streamed through processing.
+        If release is True the pixel data of each list is cleared as soon as
+        the next one is requested, keeping memory flat whatever the flight size.
+        """
+        chunks = (self.captures[i:i+chunk_size] for i in range(0, len(self.captures), chunk_size))
+        if release:
+            return released(chunks)
+        return chunks
+
+    @classmethod
+    def watch(cls, directory, interval=10, idle_timeout=300, imgset=None, release=False, **kwargs):
+        """
+        Generator yielding lists of newly completed captures as they appear in
+        directory (see update), until nothing new has turned up for idle_timeout
+        seconds. The ImageSet collecting them can be passed in as imgset.
+        If release is True each list's pixel data is cleared once the next is
+        requested (see released).
+        """
+        if imgset is None:
+            imgset = cls([], sort=False)
+        batches = cls._watch(imgset, directory, interval, idle_timeout, **kwargs)
+        if release:
+            return released(batches)
+        return batches
+
+    @staticmethod
+    def _watch(imgset, directory, interval, idle_timeout, **kwargs):
+        idle = 0
+        while True:
+            added = imgset.update(directory, **kwargs)
+            if added:
+                idle = 0
+                yield added
+                continue
+            if idle >= idle_timeout:
+                return
+            time.sleep(interval)
+            idle += interval
+
+    def read_metadata(self, chunk_size=256):
+        """
+        Read the metadata of the lazy images that have not read it yet with one
+        batched read (metadata.Metadata.from_files) per chunk_size files,
+        rather than one read per image as their attributes are first used
+        """
+        pending = {}
+        for cap in self.captures:
+            for img in cap.images:
+                options = img.pending_meta()
+                if options is not None:
+                    pending.setdefault(options, []).append(img)
+        for (native, cache), imgs in pending.items():
+            for i in range(0, len(imgs), chunk_size):
+                chunk = imgs[i:i+chunk_size]
+                metas = metadata.Metadata.from_files([img.path for img in chunk], native=native, cache=cache)
+                for img, meta in zip(chunk, metas):
+                    img.set_meta(meta)
+
+    def capture_index(self, rebuild=False):
+        """
+        Columnar table of the captures, built once and reused until rebuild is True
+
+        Returns
+        -------
+
+        dict of np.arrays with one row per capture (per band columns are
+        NaN/'' padded for captures missing bands):
+        capture_id, paths (n, bands), time (datetime64[us], UTC),
+        latitude, longitude, altitude, dls_yaw, dls_pitch, dls_roll,
+        irradiance, exposure, gain (n, bands) and center_wavelength (bands,)
+        """
+        if getattr(self, '_index', None) is not None and not rebuild:
+            return self._index
+        self.read_metadata()
+        caps = self.captures
+        nbands = max(cap.num_bands for cap in caps)
+
+        def per_band(values):
+            return list(values) + [np.nan] * (nbands - len(values))
+
+        location = np.array([cap.location() for cap in caps], dtype=np.float64).reshape(-1, 3)
+        pose = np.array([cap.dls_pose() for cap in caps], dtype=np.float64).reshape(-1, 3)
+        self._index = {
+            'capture_id': np.array([str(cap.uuid) for cap in caps]),
+            'paths': np.array([[img.path for img in cap.images] + [''] * (nbands - cap.num_bands)
+                               for cap in caps]),
+            'time': np.array([np.datetime64(cap.utc_time().replace(tzinfo=None), 'us') for cap in caps],
+                             dtype='datetime64[us]'),
+            'latitude': location[:, 0],
+            'longitude': location[:, 1],
+            'altitude': location[:, 2],
+            'dls_yaw': pose[:, 0],
+            'dls_pitch': pose[:, 1],
+            'dls_roll': pose[:, 2],
+            'irradiance': np.array([per_band(cap.dls_irradiance()) for cap in caps], dtype=np.float64),
+            'exposure': np.array([per_band([img.exposure_time for img in cap.images]) for cap in caps],
+                                 dtype=np.float64),
+            'gain': np.array([per_band([img.gain for img in cap.images]) for cap in caps], dtype=np.float64),
+            'center_wavelength': np.array(per_band(caps[0].center_wavelengths()), dtype=np.float64),
+        }
+        return self._index
+
+    def save_index(self, path):
+        """
+        Save the capture index (see capture_index) to an uncompressed .npz
+        so it can be reloaded without touching the imagery
+        """
+        np.savez(path, **self.capture_index())
+
+    @staticmethod
+    def load_index(path):
+        """ Load a capture index written by save_index as a dict of np.arrays """
+        with np.load(path, allow_pickle=False) as npz:
+            return dict((k, npz[k]) for k in npz.files)
+
+    @classmethod
+    def from_index(cls, path, native=False, cache=None):
+        """
+        Recreate an ImageSet from a saved capture index. The captures are
+        lazy (see from_directory) and the loaded index is reused as is.
+        """
+        index = cls.load_index(path)
+        store = metadata.metadata_cache(cache)
+        captures = [capture.Capture([image.Image(p, lazy=True, native=native, cache=store)
+                                     for p in row if p != ''], lazy=True)
+                    for row in index['paths']]
+        imgset = cls(captures, sort=False)
+        imgset._index = index
+        return imgset
+
     def as_nested_lists(self):
         columns = [
             'timestamp',
             'latitude','longitude','altitude',
             'dls-yaw','dls-pitch','dls-roll'
         ]
+        index = self.capture_index()
+        nbands = self.captures[0].num_bands
         irr = ["irr-{}".format(wve) for wve in self.captures[0].center_wavelengths()]
         columns += irr
-        data = [] 
-        for cap in self.captures:
-            dat = cap.utc_time()
-            loc = list(cap.location())
-            dls_pose = list(cap.dls_pose())
-            irr = cap.dls_irradiance()
-            row = [dat]+loc+dls_pose+irr
-            data.append(row)
+        table = np.column_stack([index['latitude'], index['longitude'], index['altitude'],
+                                 index['dls_yaw'], index['dls_pitch'], index['dls_roll'],
+                                 index['irradiance'][:, :nbands]])
+        times = [pytz.utc.localize(t) for t in index['time'].astype(object)]
+        data = [[dat] + row for dat, row in zip(times, table.tolist())]
         return data, columns
 
     def dls_irradiance(self):
+        index = self.capture_index()
+        nbands = self.captures[0].num_bands
+        times = [pytz.utc.localize(t).isoformat() for t in index['time'].astype(object)]
         series = {}
-        for cap in self.captures:
-            dat = cap.utc_time().isoformat()
-            irr = cap.dls_irradiance()
+        for dat, irr in zip(times, index['irradiance'][:, :nbands].tolist()):
             series[dat] = irr
+        return series
 
@@ -26,6 +26,7 @@ CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 import cv2
 import numpy as np
 import multiprocessing
+import pycmac.micasense.utils as utils
 from skimage import exposure
 from skimage.morphology import disk
 from skimage.filters import rank, gaussian
@@ -41,6 +42,13 @@ def normalize(im, min=None, max=None):
     norm[norm>1.0] = 1.0
     return norm
 
+def quantize(planes, out, scale=32768):
+    '''Min-max normalise each band of the (bands, h, w) planes to 0..scale,
+    rounded into the matching band of the uint16 out, without temporaries'''
+    for band, q in zip(planes, out):
+        cv2.normalize(band, q, alpha=0, beta=scale, norm_type=cv2.NORM_MINMAX, dtype=cv2.CV_16U)
+    return out
+
 def local_normalize(im):
     norm = normalize(im) # TODO: mainly using this as a type conversion, but it's expensive
     width, height = im.shape
@@ -59,6 +67,104 @@ def gradient(im, ksize=5):
     grad = cv2.addWeighted(np.absolute(grad_x), 0.5, np.absolute(grad_y), 0.5, 0)
     return grad
 
+def sobel_gradient(im, ksize=3):
+    ''' Cheap gradient magnitude of the min-max normalised image, without the
+    local histogram equalisation of gradient() '''
+    im = cv2.normalize(im, None, 0.0, 1.0, cv2.NORM_MINMAX, cv2.CV_32F)
+    grad_x = cv2.Sobel(im, cv2.CV_32F, 1, 0, ksize=ksize)
+    grad_y = cv2.Sobel(im, cv2.CV_32F, 0, 1, ksize=ksize)
+    return cv2.addWeighted(np.absolute(grad_x), 0.5, np.absolute(grad_y), 0.5, 0)
+
+def texture_roi(im, fraction=0.5, scale=0.125):
+    ''' (left, top, width, height) of the window of fraction of each image
+    dimension holding the most gradient energy, searched at scale resolution '''
+    small = cv2.resize(im, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    energy = sobel_gradient(small).astype(np.float64)**2
+    rows, cols = energy.shape
+    wr, wc = max(1, int(rows*fraction)), max(1, int(cols*fraction))
+    ii = cv2.integral(energy)
+    sums = ii[wr:, wc:] - ii[:-wr, wc:] - ii[wr:, :-wc] + ii[:-wr, :-wc]
+    top, left = np.unravel_index(np.argmax(sums), sums.shape)
+    height, width = im.shape[:2]
+    h, w = int(height*fraction), int(width*fraction)
+    left = min(int(left/scale), width - w)
+    top = min(int(top/scale), height - h)
+    return left, top, w, h
+
+def _scale_warp(warp_matrix, factor):
+    # the warp of the same motion on images factor times larger
+    if warp_matrix.shape[0] == 3:
+        return warp_matrix * np.array([[1,1,factor],[1,1,factor],[1./factor,1./factor,1]], dtype=np.float32)
+    return warp_matrix * np.array([[1,1,factor],[1,1,factor]], dtype=np.float32)
+
+def _align_adaptive(pair):
+    ''' Coarse to fine ECC on a textured region of interest, see align '''
+    warp_mode = pair['warp_mode']
+    translations = pair['translations']
+    criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, pair['max_iterations'], pair['epsilon_threshold'])
+    plateau = pair.get('plateau', 1e-3)
+    roi = pair.get('roi', 0.5)
+
+    gray1 = pair['ref_image']
+    gray2 = pair['match_image']
+    if gray2.shape != gray1.shape:
+        gray2 = cv2.resize(gray2, (gray1.shape[1], gray1.shape[0]), interpolation=cv2.INTER_AREA)
+    if roi:
+        left, top, w, h = texture_roi(gray1, roi)
+    else:
+        left, top, (h, w) = 0, 0, gray1.shape
+    gray1 = gray1[top:top+h, left:left+w]
+    gray2 = gray2[top:top+h, left:left+w]
+
+    # start at about min_width pixels across
+    nol = max(0, int(np.log2(w / pair.get('min_width', 160))))
+    gray1_pyr = [gray1]
+    gray2_pyr = [gray2]
+    for level in range(nol):
+        gray1_pyr.insert(0, cv2.resize(gray1_pyr[0], None, fx=1/2, fy=1/2, interpolation=cv2.INTER_AREA))
+        gray2_pyr.insert(0, cv2.resize(gray2_pyr[0], None, fx=1/2, fy=1/2, interpolation=cv2.INTER_AREA))
+
+    warp_matrix = np.eye(3 if warp_mode == cv2.MOTION_HOMOGRAPHY else 2, 3, dtype=np.float32)
+    warp_matrix[0][2] = translations[1] / (2**nol)
+    warp_matrix[1][2] = translations[0] / (2**nol)
+
+    ecc_levels = []
+    for level in range(nol+1):
+        try:
+            cc, warp_matrix = cv2.findTransformECC(sobel_gradient(gray1_pyr[level]), sobel_gradient(gray2_pyr[level]),
+                                                   warp_matrix, warp_mode, criteria, inputMask=None, gaussFiltSize=1)
+        except cv2.error:
+            if level == 0:
+                raise
+            # keep what the coarser levels found
+            warp_matrix = _scale_warp(warp_matrix, 2**(nol-level))
+            break
+        ecc_levels.append(cc)
+        if level == nol:
+            break
+        if len(ecc_levels) > 1 and abs(ecc_levels[-1] - ecc_levels[-2]) < plateau:
+            # correlation has plateaued, finer levels would not move the warp
+            warp_matrix = _scale_warp(warp_matrix, 2**(nol-level))
+            break
+        warp_matrix = _scale_warp(warp_matrix, 2)
+
+    # from region of interest to full image coordinates
+    offset = np.array([[1,0,left],[0,1,top],[0,0,1]], dtype=np.float64)
+    back = np.array([[1,0,-left],[0,1,-top],[0,0,1]], dtype=np.float64)
+    full = np.eye(3)
+    full[:warp_matrix.shape[0]] = warp_matrix
+    full = offset.dot(full).dot(back)
+    if warp_mode == cv2.MOTION_HOMOGRAPHY:
+        full = full / full[2, 2]
+    warp_matrix = full[:warp_matrix.shape[0]].astype(np.float32)
+
+    return {'ref_index': pair['ref_index'],
+            'match_index': pair['match_index'],
+            'warp_matrix': warp_matrix,
+            'ecc': ecc_levels[-1] if ecc_levels else None,
+            'ecc_levels': ecc_levels,
+            'roi': (left, top, w, h)}
+
 def relatives_ref_band(capture):
     for img in capture.images:
         if img.rig_xy_offset_in_px() == (0,0):
@@ -80,6 +186,11 @@ def align(pair):
         'epsilon_threshold': Solver stopping threshold
         'ref_index': index of reference image
         'match_index': index of image to match to reference
+        'adaptive': optional, if True align on the most textured region
+                    of interest (roi, fraction of each dimension, default 0.5)
+                    coarse to fine from about min_width (default 160) pixels
+                    across, stopping once the ECC correlation of successive
+                    levels changes by less than plateau (default 1e-3)
     }
     @returns:
     Dictionary of the following form:
@@ -87,6 +198,9 @@ def align(pair):
         'ref_index': index of reference image
         'match_index': index of image to match to reference
         'warp_matrix': transformation matrix to use to map match image to reference image frame
+        'ecc': correlation coefficient of the final (full resolution) ECC level, None for the reference
+        'ecc_levels': adaptive only, correlation reached at each level run, coarsest first
+        'roi': adaptive only, (left, top, width, height) of the region aligned on
     }
 
     Major props to Alexander Reynolds ( https://stackoverflow.com/users/5087436/alexander-reynolds ) for his
@@ -94,6 +208,8 @@ def align(pair):
     https://stackoverflow.com/questions/45997891/cv2-motion-euclidean-for-the-warp-mode-in-ecc-image-alignment-method
 
     """
+    if pair.get('adaptive') and pair['ref_index'] != pair['match_index']:
+        return _align_adaptive(pair)
     warp_mode = pair['warp_mode']
     max_iterations = pair['max_iterations']
     epsilon_threshold = pair['epsilon_threshold']
@@ -116,6 +232,7 @@ def align(pair):
 
     warp_matrix[0][2] /= (2**nol)
     warp_matrix[1][2] /= (2**nol)
+    cc = None
 
     if ref_index != match_index:
 
@@ -168,15 +285,20 @@ def align(pair):
 
     return {'ref_index': pair['ref_index'],
             'match_index': pair['match_index'],
-            'warp_matrix': warp_matrix }
+            'warp_matrix': warp_matrix,
+            'ecc': cc }
 
-def align_capture(capture, ref_index=0, warp_mode=cv2.MOTION_HOMOGRAPHY, max_iterations=2500, epsilon_threshold=1e-9, multithreaded=False, debug=False):
+def align_capture(capture, ref_index=0, warp_mode=cv2.MOTION_HOMOGRAPHY, max_iterations=2500, epsilon_threshold=1e-9, multithreaded=False, debug=False,
+                  adaptive=False, roi=0.5, plateau=1e-3):
     '''Align images in a capture using openCV
     MOTION_TRANSLATION sets a translational motion model; warpMatrix is 2x3 with the first 2x2 part being the unity matrix and the rest two parameters being estimated.
     MOTION_EUCLIDEAN sets a Euclidean (rigid) transformation as motion model; three parameters are estimated; warpMatrix is 2x3.
     MOTION_AFFINE sets an affine motion model (DEFAULT); six parameters are estimated; warpMatrix is 2x3.
     MOTION_HOMOGRAPHY sets a homography as a motion model; eight parameters are estimated;`warpMatrix` is 3x3.
     best results will be AFFINE and HOMOGRAPHY, at the expense of speed
+    The ECC correlation reached for each band is added to its alignment pair as 'ecc'
+    adaptive, roi and plateau select the coarse to fine alignment of align,
+    which also adds the per level correlations as 'ecc_levels'
     '''
     # Match other bands to this reference image (index into capture.images[])
     ref_img = capture.images[ref_index].undistorted(capture.images[ref_index].radiance()).astype('float32')
@@ -195,9 +317,13 @@ def align_capture(capture, ref_index=0, warp_mode=cv2.MOTION_HOMOGRAPHY, max_ite
                                     'match_index':img.band_index,
                                     'match_image':img.undistorted(img.radiance()).astype('float32'),
                                     'translations': translations,
-                                    'debug': debug})
+                                    'debug': debug,
+                                    'adaptive': adaptive,
+                                    'roi': roi,
+                                    'plateau': plateau})
 
     warp_matrices = [None]*len(alignment_pairs)
+    results = {} # match index -> result of align
 
     if(multithreaded):
         #required to work across linux/mac/windows, see https://stackoverflow.com/questions/47852237
@@ -206,6 +332,7 @@ def align_capture(capture, ref_index=0, warp_mode=cv2.MOTION_HOMOGRAPHY, max_ite
         pool = multiprocessing.Pool(processes=multiprocessing.cpu_count())
         for _,mat in enumerate(pool.imap_unordered(align, alignment_pairs)):
             warp_matrices[mat['match_index']] = mat['warp_matrix']
+            results[mat['match_index']] = mat
             print("Finished aligning band {}".format(mat['match_index']))
         pool.close()
         pool.join()
@@ -214,8 +341,15 @@ def align_capture(capture, ref_index=0, warp_mode=cv2.MOTION_HOMOGRAPHY, max_ite
         for pair in alignment_pairs:
             mat = align(pair)
             warp_matrices[mat['match_index']] = mat['warp_matrix']
+            results[mat['match_index']] = mat
             print("Finished aligning band {}".format(mat['match_index']))
 
+    for pair in alignment_pairs:
+        mat = results.get(pair['match_index'], {})
+        pair['ecc'] = mat.get('ecc')
+        if 'ecc_levels' in mat:
+            pair['ecc_levels'] = mat['ecc_levels']
+
     if capture.images[-1].band_name == 'LWIR':
         img = capture.images[-1]
         alignment_pairs.append({'warp_mode': warp_mode,
@@ -231,12 +365,46 @@ def align_capture(capture, ref_index=0, warp_mode=cv2.MOTION_HOMOGRAPHY, max_ite
     return warp_matrices, alignment_pairs
 
 #apply homography to create an aligned stack
-def aligned_capture(capture, warp_matrices, warp_mode, cropped_dimensions, match_index, img_type = 'reflectance',interpolation_mode=cv2.INTER_LANCZOS4):
+def aligned_capture(capture, warp_matrices, warp_mode, cropped_dimensions, match_index, img_type = 'reflectance',interpolation_mode=cv2.INTER_LANCZOS4, n_jobs=None, fused=True, out=None):
+    '''Undistort and warp every band onto the reference, then crop
+    Bands are processed in parallel on n_jobs threads (see utils.map_bands).
+    If fused, each band is resampled once through the cached
+    utils.registration_maps table straight into the cropped stack, otherwise
+    it is undistorted, warped over the full frame and then cropped.
+    out is an optional float32 (bands, h, w) array the fused path writes into,
+    e.g. one recycled through a utils.BufferPool'''
+    (left, top, w, h) = tuple(int(i) for i in cropped_dimensions)
+
+    if fused:
+        # band planar so that every band is a contiguous remap destination
+        if out is None:
+            out = np.empty((len(warp_matrices), h, w), dtype=np.float32)
+        planes = out
+
+        def remap_band(i):
+            image = capture.images[i]
+            if img_type == 'reflectance':
+                img = image.reflectance()
+            else:
+                img = image.radiance()
+            map1, map2 = utils.registration_maps(image.cv2_camera_matrix(),
+                                                 image.cv2_distortion_coeff(),
+                                                 image.size(),
+                                                 warp_matrices[i], warp_mode,
+                                                 cropped_dimensions)
+            band = cv2.remap(img, map1, map2, interpolation_mode, dst=planes[i])
+            if not np.shares_memory(band, planes):
+                # remapped in the dtype of a non float32 source
+                planes[i] = band
+
+        utils.map_bands(remap_band, range(0,len(warp_matrices)), n_jobs)
+        return np.moveaxis(planes, 0, -1)
+
     width, height = capture.images[0].size()
 
     im_aligned = np.zeros((height,width,len(warp_matrices)), dtype=np.float32 )
 
-    for i in range(0,len(warp_matrices)):
+    def warp_band(i):
         if img_type == 'reflectance':
             img = capture.images[i].undistorted_reflectance()
         else:
@@ -252,11 +420,34 @@ def aligned_capture(capture, warp_matrices, warp_mode, cropped_dimensions, match
                                                 warp_matrices[i],
                                                 (width,height),
                                                 flags=interpolation_mode + cv2.WARP_INVERSE_MAP)
-    (left, top, w, h) = tuple(int(i) for i in cropped_dimensions)
+
+    utils.map_bands(warp_band, range(0,len(warp_matrices)), n_jobs)
     im_cropped = im_aligned[top:top+h, left:left+w][:]
 
     return im_cropped
 
+def composites(capture, warp_matrices, warp_mode, cropped_dimensions, match_index, pool=None):
+    '''RGB (bands 3, 2, 1) and RRENir (bands 5, 4, 3) uint16 composites of the
+    aligned reflectance of capture, each band normalised to 0-32768.
+    The aligned stack, its quantized bands and the composites come from pool
+    (a utils.BufferPool, a new one by default); the intermediates go back to it
+    and the caller releases the composites once done with them'''
+    if pool is None:
+        pool = utils.BufferPool()
+    (left, top, w, h) = tuple(int(i) for i in cropped_dimensions)
+    planes = pool.acquire((len(warp_matrices), h, w), np.float32)
+    quantized = pool.acquire((5, h, w), np.uint16)
+    aligned_capture(capture, warp_matrices, warp_mode, cropped_dimensions,
+                    match_index, img_type='reflectance', out=planes)
+    quantize(planes[:5], quantized)
+
+    rgb = pool.acquire((h, w, 3), np.uint16)
+    rrenir = pool.acquire((h, w, 3), np.uint16)
+    cv2.merge([quantized[2], quantized[1], quantized[0]], rgb)
+    cv2.merge([quantized[4], quantized[3], quantized[2]], rrenir)
+    pool.release(planes, quantized)
+    return rgb, rrenir
+
 class BoundPoint(object):
     def __init__(self, x=0, y=0):
         self.x = x
@@ -299,8 +490,9 @@ def find_crop_bounds(capture,registration_transforms,warp_mode=cv2.MOTION_HOMOGR
     lens_distortions = [image.cv2_distortion_coeff() for image in capture.images]
     camera_matrices =  [image.cv2_camera_matrix() for image in capture.images]
 
-    bounds = [get_inner_rect(s, a, d, c,warp_mode=warp_mode)[0] for s,a, d, c in zip(image_sizes,registration_transforms, lens_distortions, camera_matrices)]
-    edges = [get_inner_rect(s, a, d, c,warp_mode=warp_mode)[1] for s,a, d, c in zip(image_sizes,registration_transforms, lens_distortions, camera_matrices)]
+    inner = [get_inner_rect(s, a, d, c,warp_mode=warp_mode) for s,a, d, c in zip(image_sizes,registration_transforms, lens_distortions, camera_matrices)]
+    bounds = [b for b, _ in inner]
+    edges = [e for _, e in inner]
     combined_bounds = get_combined_bounds(bounds, image_sizes[0])
 
     left = round(combined_bounds.min.x)
@@ -313,18 +505,19 @@ def get_inner_rect(image_size, affine, distortion_coeffs, camera_matrix,warp_mod
     w = image_size[0]
     h = image_size[1]
 
-    left_edge = np.array([np.ones(h)*0, np.arange(0, h)]).T
-    right_edge = np.array([np.ones(h)*(w-1), np.arange(0, h)]).T
-    top_edge = np.array([np.arange(0, w), np.ones(w)*0]).T
-    bottom_edge = np.array([np.arange(0, w), np.ones(w)*(h-1)]).T
+    # map all four edges with one undistort/transform call
+    rows = np.arange(0, h)
+    cols = np.arange(0, w)
+    pts = np.concatenate([np.column_stack([np.zeros(h), rows]),
+                          np.column_stack([np.full(h, w-1), rows]),
+                          np.column_stack([cols, np.zeros(w)]),
+                          np.column_stack([cols, np.full(w, h-1)])])
+    mapped = map_points(pts, image_size, affine, distortion_coeffs, camera_matrix,warp_mode=warp_mode)
+    left_map, right_map, top_map, bottom_map = np.split(mapped, [h, 2*h, 2*h+w])
 
-    left_map = map_points(left_edge, image_size, affine, distortion_coeffs, camera_matrix,warp_mode=warp_mode)
     left_bounds = min_max(left_map)
-    right_map = map_points(right_edge, image_size, affine, distortion_coeffs, camera_matrix,warp_mode=warp_mode)
     right_bounds = min_max(right_map)
-    top_map = map_points(top_edge, image_size, affine, distortion_coeffs, camera_matrix,warp_mode=warp_mode)
     top_bounds = min_max(top_map)
-    bottom_map = map_points(bottom_edge, image_size, affine, distortion_coeffs, camera_matrix,warp_mode=warp_mode)
     bottom_bounds = min_max(bottom_map)
 
     bounds = Bounds()
@@ -366,27 +559,24 @@ def get_combined_bounds(bounds, image_size):
 
 def min_max(pts):
     bounds = Bounds()
-    for p in pts:
-        if p[0] > bounds.max.x:
-            bounds.max.x = p[0]
-        if p[1] > bounds.max.y:
-            bounds.max.y = p[1]
-        if p[0] < bounds.min.x:
-            bounds.min.x = p[0]
-        if p[1] < bounds.min.y:
-            bounds.min.y = p[1]
+    pts = np.asarray(pts)
+    if len(pts):
+        lo = pts.min(axis=0)
+        hi = pts.max(axis=0)
+        bounds.min.x, bounds.min.y = min(lo[0], bounds.min.x), min(lo[1], bounds.min.y)
+        bounds.max.x, bounds.max.y = max(hi[0], bounds.max.x), max(hi[1], bounds.max.y)
     return bounds
 
 def map_points(pts, image_size, warpMatrix, distortion_coeffs, camera_matrix,warp_mode=cv2.MOTION_HOMOGRAPHY):
     #assert len(affine) == 6, "affine must have len == 6, has len {}".format(len(affine))
 
     # extra dimension makes opencv happy
-    pts = np.array([pts], dtype=np.float)
+    pts = np.array([pts], dtype=np.float64)
 
-    new_cam_mat, _ = cv2.getOptimalNewCameraMatrix(camera_matrix, distortion_coeffs, image_size, 1)
+    new_cam_mat = utils.optimal_camera_matrix(camera_matrix, distortion_coeffs, image_size)
     new_pts = cv2.undistortPoints(pts, camera_matrix, distortion_coeffs, P=new_cam_mat)
     if warp_mode == cv2.MOTION_AFFINE:
         new_pts = cv2.transform(new_pts, cv2.invertAffineTransform(warpMatrix))
     if warp_mode == cv2.MOTION_HOMOGRAPHY:
         new_pts =cv2.perspectiveTransform(new_pts,np.linalg.inv(warpMatrix).astype(np.float32))
-    return new_pts[0]
+    return new_pts.reshape(-1, 2)
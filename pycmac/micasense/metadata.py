@@ -30,21 +30,243 @@ from datetime import datetime, timedelta
 import pytz
 import os
 import math
+import atexit
+import threading
+import sqlite3
+import json
+import pycmac.micasense.tiffmeta as tiffmeta
+
+# every tag read by the Metadata accessors, records are trimmed to these by compact_record
+TAGS = frozenset([
+    'SourceFile',
+    'EXIF:BitsPerSample', 'EXIF:BlackLevel', 'EXIF:DateTimeOriginal', 'EXIF:ExposureTime',
+    'EXIF:FocalLength', 'EXIF:FocalPlaneXResolution', 'EXIF:FocalPlaneYResolution',
+    'EXIF:GPSAltitude', 'EXIF:GPSLatitude', 'EXIF:GPSLatitudeRef', 'EXIF:GPSLongitude',
+    'EXIF:GPSLongitudeRef', 'EXIF:ISOSpeed', 'EXIF:ImageHeight', 'EXIF:ImageWidth',
+    'EXIF:Make', 'EXIF:Model', 'EXIF:SerialNumber', 'EXIF:Software', 'EXIF:SubSecTime',
+    'XMP:Albedo', 'XMP:BandName', 'XMP:CalibrationPicture', 'XMP:CaptureId',
+    'XMP:CentralWavelength', 'XMP:DarkRowValue', 'XMP:DirectIrradiance',
+    'XMP:EstimatedDirectLightVector', 'XMP:FlightId', 'XMP:HorizontalIrradiance',
+    'XMP:Irradiance', 'XMP:PanelSerial', 'XMP:PerspectiveDistortion',
+    'XMP:PerspectiveFocalLength', 'XMP:PerspectiveFocalLengthUnits', 'XMP:Pitch',
+    'XMP:PrincipalPoint', 'XMP:RadiometricCalibration', 'XMP:ReflectArea',
+    'XMP:RigCameraIndex', 'XMP:RigRelatives', 'XMP:Roll', 'XMP:ScatteredIrradiance',
+    'XMP:SolarAzimuth', 'XMP:SolarElevation', 'XMP:SpectralIrradiance',
+    'XMP:VignettingCenter', 'XMP:VignettingPolynomial', 'XMP:WavelengthFWHM', 'XMP:Yaw'])
+
+def compact_record(exif):
+    ''' Drop the tags no accessor reads from a metadata record '''
+    return dict((k, v) for k, v in exif.items() if k in TAGS)
+
+# one -stay_open exiftool process per worker process, keyed by executable
+_sessions = {}
+_session_lock = threading.Lock()
+
+def exiftool_path(exiftoolPath=None):
+    ''' Resolve the exiftool executable from the argument or the exiftoolpath env var '''
+    if exiftoolPath is not None:
+        return exiftoolPath
+    if os.environ.get('exiftoolpath') is not None:
+        return os.path.normpath(os.environ.get('exiftoolpath'))
+    return None
+
+def exiftool_session(exiftoolPath=None):
+    ''' Get the persistent exiftool process of this worker, starting it on first use.
+    The process is keyed by pid so forked pool workers never share the parent pipes.
+    Callers must hold the session lock while talking to it. '''
+    key = (os.getpid(), exiftool_path(exiftoolPath))
+    et = _sessions.get(key)
+    if et is None or not et.running:
+        et = exiftool.ExifTool(key[1])
+        et.start()
+        _sessions[key] = et
+    return et
+
+def close_exiftool_sessions():
+    ''' Terminate the exiftool processes started by this worker '''
+    with _session_lock:
+        for key in list(_sessions):
+            if key[0] == os.getpid() and _sessions[key].running:
+                _sessions[key].terminate()
+            del _sessions[key]
+
+atexit.register(close_exiftool_sessions)
+
+# path of the metadata cache used when no cache argument is given, unset for none
+CACHE_ENV = 'PYCMAC_METADATA_CACHE'
+
+def default_cache_path():
+    ''' Location of the shared metadata cache: $PYCMAC_METADATA_CACHE, otherwise
+    under $XDG_CACHE_HOME or ~/.cache '''
+    if os.environ.get(CACHE_ENV):
+        return os.environ[CACHE_ENV]
+    base = os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(base, 'pycmac', 'metadata.sqlite')
+
+class MetadataCache(object):
+    ''' Persistent SQLite store of extracted metadata records.
+    Records are keyed by absolute path and reader (native tiffmeta or exiftool,
+    whose records differ) and are only returned while the file size and mtime
+    still match those recorded at extraction time. '''
+    def __init__(self, path=None):
+        self.path = path if path is not None else default_cache_path()
+        folder = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        self._local = threading.local()
+
+    def __getstate__(self):
+        # connections can't cross process or thread boundaries
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.path = state['path']
+        self._local = threading.local()
+
+    def _connect(self):
+        # one connection per thread and process
+        local = self._local
+        if getattr(local, 'conn', None) is None or local.pid != os.getpid():
+            local.conn = sqlite3.connect(self.path, timeout=60)
+            local.conn.execute('CREATE TABLE IF NOT EXISTS records '
+                               '(path TEXT, reader TEXT, size INTEGER, mtime INTEGER, exif TEXT, '
+                               'PRIMARY KEY (path, reader))')
+            local.pid = os.getpid()
+        return local.conn
+
+    @staticmethod
+    def _reader(native):
+        return 'native' if native else 'exiftool'
+
+    @staticmethod
+    def _stamp(path):
+        st = os.stat(path)
+        return st.st_size, st.st_mtime_ns
+
+    def get_many(self, paths, native=False):
+        ''' Return {path: exif} for the paths with a valid cached record
+        extracted by the same reader (see get_metadata_batch) '''
+        conn = self._connect()
+        found = {}
+        for i in range(0, len(paths), 500):
+            chunk = paths[i:i+500]
+            keys = dict((os.path.abspath(p), p) for p in chunk)
+            rows = conn.execute('SELECT path, size, mtime, exif FROM records '
+                                'WHERE reader = ? AND path IN ({})'.format(','.join('?' * len(keys))),
+                                [self._reader(native)] + list(keys)).fetchall()
+            for key, size, mtime, exif in rows:
+                path = keys[key]
+                if self._stamp(path) == (size, mtime):
+                    found[path] = json.loads(exif)
+        return found
+
+    def put_many(self, paths, exifs, native=False):
+        ''' Store the metadata records of paths, as extracted by the native reader or exiftool '''
+        conn = self._connect()
+        reader = self._reader(native)
+        rows = [(os.path.abspath(p), reader) + self._stamp(p) + (json.dumps(e),) for p, e in zip(paths, exifs)]
+        with conn:
+            conn.executemany('INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?)', rows)
+
+def metadata_cache(cache):
+    ''' Normalise a cache argument: True for the default location, a path,
+    a MetadataCache, False for no caching or None for the $PYCMAC_METADATA_CACHE
+    path if that is set and no caching otherwise.
+    A cache that can not be created or written (read-only or sandboxed
+    locations) is silently left out. '''
+    if cache is None:
+        cache = os.environ.get(CACHE_ENV) or False
+    if cache is False:
+        return None
+    if isinstance(cache, MetadataCache):
+        return cache
+    try:
+        store = MetadataCache(None if cache is True else cache)
+        with store._connect() as conn:
+            # opening a database does not check it can be written
+            conn.execute('DELETE FROM records WHERE 0')
+    except (OSError, sqlite3.Error):
+        return None
+    return store
+
+def get_metadata_batch(paths, exiftoolPath=None, chunk_size=256, native=False, cache=None):
+    ''' Extract the metadata of many files through the persistent exiftool session,
+    or with the in-process tiffmeta reader if native is True.
+    Files with a valid record in cache (see metadata_cache) are not read at all,
+    records are then returned trimmed by compact_record.
+    Returns a list of exif dicts in the same order as paths. '''
+    for path in paths:
+        if not os.path.isfile(path):
+            raise IOError("Input path is not a file: {}".format(path))
+    store = metadata_cache(cache)
+    if store is not None:
+        found = store.get_many(paths, native)
+        todo = [p for p in paths if p not in found]
+        if todo:
+            exifs = [compact_record(e) for e in get_metadata_batch(todo, exiftoolPath, chunk_size, native, False)]
+            store.put_many(todo, exifs, native)
+            found.update(zip(todo, exifs))
+        return [found[p] for p in paths]
+    if native:
+        return tiffmeta.get_metadata_batch(paths)
+    exifs = []
+    with _session_lock:
+        et = exiftool_session(exiftoolPath)
+        for i in range(0, len(paths), chunk_size):
+            exifs.extend(et.get_metadata_batch(paths[i:i+chunk_size]))
+    if len(exifs) != len(paths):
+        raise IOError("exiftool returned {} records for {} files".format(len(exifs), len(paths)))
+    return exifs
+
+# the tags exiftool copies onto outputs whose source tiffmeta can not parse
+COPY_ARGS = ["-file:all", "-iptc:all", "-exif:all", "-xmp", "-Composite:all"]
+
+def source_tags(src, size=None):
+    ''' The tags of src for tiffmeta.write_tiff (see tiffmeta.output_tags), or
+    None for a source the native reader can not parse (e.g. BigTIFF) '''
+    try:
+        return tiffmeta.output_tags(src, size)
+    except IOError:
+        return None
+
+def write_tagged(path, data, src, tags=None, exiftoolPath=None):
+    ''' Write data to path along with the tags of src (or tags, see source_tags)
+    in a single pass. When src can not be parsed natively the pixels are written
+    by imageio and the tags copied afterwards by exiftool -tagsFromFile '''
+    if tags is None:
+        tags = source_tags(src, (data.shape[1], data.shape[0]))
+    if tags is not None:
+        tiffmeta.write_tiff(path, data, **tags)
+        return
+    import imageio
+    imageio.imwrite(path, data)
+    args = ['-tagsFromFile', src] + COPY_ARGS + [path, '-overwrite_original']
+    with _session_lock:
+        exiftool_session(exiftoolPath).execute(*[os.fsencode(a) for a in args])
 
 class Metadata(object):
     ''' Container for Micasense image metadata'''
-    def __init__(self, filename, exiftoolPath=None):
+    __slots__ = ('xmpfile', 'exiftoolPath', 'exif')
+
+    def __init__(self, filename, exiftoolPath=None, exif=None, native=False, cache=None):
         self.xmpfile = None
-        if exiftoolPath is not None:
-            self.exiftoolPath = exiftoolPath
-        elif os.environ.get('exiftoolpath') is not None:
-            self.exiftoolPath = os.path.normpath(os.environ.get('exiftoolpath'))
-        else:
-            self.exiftoolPath = None
+        self.exiftoolPath = exiftool_path(exiftoolPath)
         if not os.path.isfile(filename):
             raise IOError("Input path is not a file")
-        with exiftool.ExifTool(self.exiftoolPath) as exift:
-            self.exif = exift.get_metadata(filename)
+        if exif is None:
+            exif = get_metadata_batch([filename], self.exiftoolPath, native=native, cache=cache)[0]
+        self.exif = exif
+
+    @classmethod
+    def from_files(cls, filenames, exiftoolPath=None, native=False, cache=None):
+        ''' Create Metadata for a list of files with a single batched read '''
+        exifs = get_metadata_batch(filenames, exiftoolPath, native=native, cache=cache)
+        return [cls(f, exiftoolPath, exif=e) for f, e in zip(filenames, exifs)]
+
+    def compact(self):
+        ''' Keep only the tags the accessors read, see compact_record '''
+        self.exif = compact_record(self.exif)
+        return self
 
     def get_all(self):
         ''' Get all extracted metadata items '''
@@ -172,6 +394,9 @@ class Metadata(object):
     def firmware_version(self):
         return self.get_item('EXIF:Software')
 
+    def camera_serial(self):
+        return self.get_item('EXIF:SerialNumber')
+
     def band_name(self):
         return self.get_item('XMP:BandName')
 
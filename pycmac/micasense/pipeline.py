@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Staged Capture Processing Pipeline
+
+    A staged read -> compute -> write pipeline so that disk reads, processing and
+    output writing of successive captures overlap.
+
+    Each stage runs in its own threads and the stages are joined by bounded
+    queues, so readers prefetch only a few items ahead of the compute stage and
+    finished results never pile up in memory ahead of the writers. The heavy
+    NumPy and OpenCV calls of the compute stage release the GIL, so a thread
+    per core keeps every core busy without pickling captures to processes.
+
+        stats = pipeline.run(captures, read, compute, write)
+        print(pipeline.format_stats(stats))
+
+Copyright 2017 MicaSense, Inc.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in the
+Software without restriction, including without limitation the rights to use,
+copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+Software, and to permit persons to whom the Software is furnished to do so,
+subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+import os
+import time
+import queue
+import threading
+
+_DONE = object()
+
+
+class StageStats(object):
+    """
+    Counts and busy time of one pipeline stage, shared by its threads
+    """
+    def __init__(self, name, threads):
+        self.name = name
+        self.threads = threads
+        self.items = 0
+        self.busy = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self.items += 1
+            self.busy += seconds
+
+    def report(self, wall):
+        """
+        Returns
+        -------
+
+        dict of items, busy (summed thread seconds), per_second (items per
+        wall clock second) and utilisation (busy / (wall * threads))
+        """
+        return {'items': self.items,
+                'threads': self.threads,
+                'busy': self.busy,
+                'per_second': self.items / wall if wall > 0 else 0.0,
+                'utilisation': self.busy / (wall * self.threads) if wall > 0 else 0.0}
+
+
+def _put(q, item, failed):
+    # a bounded put that gives up once another stage has failed
+    while not failed.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _get(q, failed):
+    while not failed.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return _DONE
+
+
+def run(items, read, compute, write, readers=2, workers=None, writers=2, depth=None,
+        progress=None):
+    """
+    Pass every item through read, compute and write, each stage in its own
+    threads connected by bounded queues
+
+    Parameters
+    ----------
+
+    items: iterable
+            the work items, e.g. Captures - consumed lazily by the readers
+
+    read: function
+            read(item) -> data, called by the reader threads (disk reads)
+
+    compute: function
+            compute(item, data) -> result, called by the compute threads
+
+    write: function
+            write(item, result), called by the writer threads
+
+    readers: int
+            number of reader threads
+
+    workers: int
+            number of compute threads, default the cpu count
+
+    writers: int
+            number of writer threads
+
+    depth: int
+            capacity of each queue, default twice the compute threads
+
+    progress: function
+            called with the number of items written so far after each write
+
+    Returns
+    -------
+
+    dict of {'read': stats, 'compute': stats, 'write': stats, 'wall': seconds},
+    see StageStats.report. The first exception raised by any stage stops the
+    pipeline and is re-raised.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if depth is None:
+        depth = 2 * workers
+    source = iter(items)
+    source_lock = threading.Lock()
+    computing = queue.Queue(maxsize=depth)
+    writing = queue.Queue(maxsize=depth)
+    failed = threading.Event()
+    errors = []
+    stats = {'read': StageStats('read', readers),
+             'compute': StageStats('compute', workers),
+             'write': StageStats('write', writers)}
+    remaining = {'read': readers, 'compute': workers}
+    remaining_lock = threading.Lock()
+
+    def finished(stage, downstream, count):
+        # the last thread of a stage tells every downstream thread to stop
+        with remaining_lock:
+            remaining[stage] -= 1
+            last = remaining[stage] == 0
+        if last:
+            for _ in range(count):
+                _put(downstream, _DONE, failed)
+
+    def fail(exc):
+        errors.append(exc)
+        failed.set()
+
+    def reader():
+        try:
+            while not failed.is_set():
+                with source_lock:
+                    try:
+                        item = next(source)
+                    except StopIteration:
+                        break
+                start = time.perf_counter()
+                data = read(item)
+                stats['read'].add(time.perf_counter() - start)
+                if not _put(computing, (item, data), failed):
+                    break
+        except Exception as exc:
+            fail(exc)
+        finally:
+            finished('read', computing, workers)
+
+    def worker():
+        try:
+            while True:
+                job = _get(computing, failed)
+                if job is _DONE:
+                    break
+                item, data = job
+                start = time.perf_counter()
+                result = compute(item, data)
+                stats['compute'].add(time.perf_counter() - start)
+                if not _put(writing, (item, result), failed):
+                    break
+        except Exception as exc:
+            fail(exc)
+        finally:
+            finished('compute', writing, writers)
+
+    def writer():
+        try:
+            while True:
+                job = _get(writing, failed)
+                if job is _DONE:
+                    break
+                item, result = job
+                start = time.perf_counter()
+                write(item, result)
+                stats['write'].add(time.perf_counter() - start)
+                if progress is not None:
+                    progress(stats['write'].items)
+        except Exception as exc:
+            fail(exc)
+
+    start = time.perf_counter()
+    threads = ([threading.Thread(target=reader, name='pipeline-read-{}'.format(n)) for n in range(readers)] +
+               [threading.Thread(target=worker, name='pipeline-compute-{}'.format(n)) for n in range(workers)] +
+               [threading.Thread(target=writer, name='pipeline-write-{}'.format(n)) for n in range(writers)])
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+    wall = time.perf_counter() - start
+    report = dict((name, s.report(wall)) for name, s in stats.items())
+    report['wall'] = wall
+    return report
+
+
+def format_stats(report):
+    """ One line per stage summary of a run() report """
+    lines = []
+    for name in ('read', 'compute', 'write'):
+        s = report[name]
+        lines.append('{:<8}{:>7} items {:>8.2f}/s  {:>2} threads {:>5.0%} busy'.format(
+            name, s['items'], s['per_second'], s['threads'], s['utilisation']))
+    lines.append('{:<8}{:>7.1f} s'.format('wall', report['wall']))
+    return '\n'.join(lines)
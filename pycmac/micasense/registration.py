@@ -0,0 +1,450 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Band Registration Utilities
+
+    Band to band registration helpers for the micasense lib.
+
+    The band registration of a camera barely changes between flights, so the
+    warp matrices found for a camera are kept in a persistent WarpCache keyed by
+    camera serial, firmware, warp type and reference band, and can be checked
+    cheaply against a new capture with registration_scores.
+
+    For cameras with a good factory calibration rig_registration derives the
+    warps from the metadata rig relatives, optionally refined by a short low
+    resolution ECC pass, instead of a full ECC alignment.
+
+    select_alignment_captures and robust_alignment pick well textured captures
+    of a flight and combine their alignments, so no operator has to choose one.
+
+Copyright 2017 MicaSense, Inc.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in the
+Software without restriction, including without limitation the rights to use,
+copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+Software, and to permit persons to whom the Software is furnished to do so,
+subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+import os
+import json
+import time
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+
+import pycmac.micasense.metadata as metadata
+import pycmac.micasense.imageutils as imageutils
+import pycmac.micasense.utils as utils
+
+
+# path of the warp cache used when no cache argument is given, unset for none
+CACHE_ENV = 'PYCMAC_WARP_CACHE'
+
+
+def default_warp_cache_path():
+    """ $PYCMAC_WARP_CACHE, otherwise warps.sqlite next to the default metadata cache """
+    if os.environ.get(CACHE_ENV):
+        return os.environ[CACHE_ENV]
+    return os.path.join(os.path.dirname(metadata.default_cache_path()), 'warps.sqlite')
+
+
+def camera_key(capture, warp_mode, ref_index, settings=None):
+    """
+    Key of the band registration of capture's camera
+    (serial, firmware, warp_mode, ref_index, number of bands, settings), where
+    settings is a dict of the alignment options (e.g. iterations, mode) that
+    change the warps found, so that runs with other options do not share them
+    """
+    meta = capture.images[0].meta
+    return (str(meta.camera_serial()), str(meta.firmware_version()),
+            int(warp_mode), int(ref_index), len(capture.images),
+            sorted((settings or {}).items()))
+
+
+class WarpCache(object):
+    """
+    Persistent SQLite store of band warp matrices per camera_key, together
+    with a quality score (see registration_scores) and the per band ECC
+    correlations of the alignment that produced them
+    """
+    def __init__(self, path=None):
+        self.path = path if path is not None else default_warp_cache_path()
+        folder = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        self._local = threading.local()
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.path = state['path']
+        self._local = threading.local()
+
+    def _connect(self):
+        local = self._local
+        if getattr(local, 'conn', None) is None or local.pid != os.getpid():
+            local.conn = sqlite3.connect(self.path, timeout=60)
+            local.conn.execute('CREATE TABLE IF NOT EXISTS warps '
+                               '(key TEXT PRIMARY KEY, warp_matrices TEXT, score REAL, '
+                               'ecc TEXT, created REAL)')
+            local.pid = os.getpid()
+        return local.conn
+
+    def get(self, key):
+        """
+        Returns
+        -------
+
+        dict of warp_matrices (list of np.float32 arrays), score, ecc and
+        created (epoch seconds), or None if nothing is stored for key
+        """
+        row = self._connect().execute('SELECT warp_matrices, score, ecc, created FROM warps WHERE key = ?',
+                                      (json.dumps(key),)).fetchone()
+        if row is None:
+            return None
+        warps, score, ecc, created = row
+        return {'warp_matrices': [np.array(w, dtype=np.float32) for w in json.loads(warps)],
+                'score': score, 'ecc': json.loads(ecc), 'created': created}
+
+    def put(self, key, warp_matrices, score=None, ecc=None):
+        """ Store the warp_matrices of key, replacing what was there """
+        conn = self._connect()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO warps VALUES (?, ?, ?, ?, ?)',
+                         (json.dumps(key), json.dumps([np.asarray(w).tolist() for w in warp_matrices]),
+                          score, json.dumps(ecc), time.time()))
+
+
+def warp_cache(cache):
+    """
+    Normalise a cache argument: True for the default location, a path,
+    a WarpCache, False for no caching or None for the $PYCMAC_WARP_CACHE path
+    if that is set and no caching otherwise. A cache that can not be created
+    or written (read-only or sandboxed locations) is silently left out.
+    """
+    if cache is None:
+        cache = os.environ.get(CACHE_ENV) or False
+    if cache is False:
+        return None
+    if isinstance(cache, WarpCache):
+        return cache
+    try:
+        store = WarpCache(None if cache is True else cache)
+        with store._connect() as conn:
+            # opening a database does not check it can be written
+            conn.execute('DELETE FROM warps WHERE 0')
+    except (OSError, sqlite3.Error):
+        return None
+    return store
+
+
+def _homography(warp_matrix):
+    warp_matrix = np.asarray(warp_matrix, dtype=np.float64)
+    if warp_matrix.shape == (2, 3):
+        warp_matrix = np.vstack([warp_matrix, [0, 0, 1]])
+    return warp_matrix
+
+
+def _correlation(a, b, mask):
+    a = a[mask] - a[mask].mean()
+    b = b[mask] - b[mask].mean()
+    denom = np.sqrt((a * a).sum() * (b * b).sum())
+    return float((a * b).sum() / denom) if denom > 0 else 0.0
+
+
+def _edges(img, scale):
+    """
+    Gradient image of a band's undistorted radiance at scale resolution and
+    the mask (uint8, 255 valid) of the pixels clear of the black undistortion
+    border, eroded by the reach of the resize and Sobel kernels
+    """
+    maps = utils.undistort_maps(img.cv2_camera_matrix(), img.cv2_distortion_coeff(), img.size())
+    im = cv2.remap(img.radiance(), maps[0], maps[1], cv2.INTER_LINEAR)
+    valid = cv2.remap(np.full(im.shape, 255, dtype=np.uint8), maps[0], maps[1], cv2.INTER_NEAREST)
+    edges = imageutils.sobel_gradient(cv2.resize(im, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA))
+    valid = cv2.resize(valid, (edges.shape[1], edges.shape[0]), interpolation=cv2.INTER_AREA)
+    valid = np.where(valid == 255, 255, 0).astype(np.uint8)
+    return edges, cv2.erode(valid, np.ones((3, 3), np.uint8), iterations=2)
+
+
+def _inner_rect(mask):
+    """ (left, top, w, h) of the valid rows and columns inside the mask's central cross """
+    rows = np.flatnonzero(mask[:, mask.shape[1] // 2])
+    cols = np.flatnonzero(mask[mask.shape[0] // 2])
+    left, right, top, bottom = cols[0], cols[-1] + 1, rows[0], rows[-1] + 1
+    # shrink until the rectangle's border lies entirely in the mask
+    while right - left > 2 and bottom - top > 2:
+        if (mask[top, left:right].all() and mask[bottom - 1, left:right].all() and
+                mask[top:bottom, left].all() and mask[top:bottom, right - 1].all()):
+            break
+        left, right, top, bottom = left + 1, right - 1, top + 1, bottom - 1
+    return left, top, right - left, bottom - top
+
+
+def registration_scores(capture, warp_matrices, ref_index, scale=0.25):
+    """
+    Check band registration cheaply: the zero-mean normalised correlation (the
+    criterion cv2.findTransformECC maximises) of each band's gradient image,
+    warped by its matrix, with the reference band's, at scale resolution
+
+    Parameters
+    ----------
+
+    capture: Capture
+            capture to check on, its undistorted radiance is used, leaving out
+            the undistortion border of either band
+
+    warp_matrices: list
+            warp matrices (2x3 affine or 3x3 homographies, inverse maps onto
+            the reference as used by aligned_capture)
+
+    ref_index: int
+            the reference band
+
+    scale: float
+            resolution relative to the full image
+
+    Returns
+    -------
+
+    dict of {band index: score} for every non reference, non LWIR band
+    """
+    S = np.diag([scale, scale, 1.0])
+    S_inv = np.diag([1.0 / scale, 1.0 / scale, 1.0])
+
+    ref, ref_valid = _edges(capture.images[ref_index], scale)
+    height, width = ref.shape
+    scores = {}
+    for i, img in enumerate(capture.images):
+        if i == ref_index or img.band_name == 'LWIR':
+            continue
+        warp = S.dot(_homography(warp_matrices[i])).dot(S_inv)
+        edges, valid = _edges(img, scale)
+        flags = cv2.INTER_LINEAR + cv2.WARP_INVERSE_MAP
+        warped = cv2.warpPerspective(edges, warp, (width, height), flags=flags)
+        valid = cv2.warpPerspective(valid, warp, (width, height),
+                                    flags=cv2.INTER_NEAREST + cv2.WARP_INVERSE_MAP)
+        scores[i] = _correlation(ref, warped, (valid > 0) & (ref_valid > 0))
+    return scores
+
+
+def warp_displacement(warp_a, warp_b, size):
+    """
+    Largest distance in pixels between where warp_a and warp_b map the
+    corners and centre of a (width, height) image
+    """
+    width, height = size
+    points = np.array([[0, 0, 1], [width, 0, 1], [0, height, 1], [width, height, 1],
+                       [width / 2.0, height / 2.0, 1]], dtype=np.float64).T
+    a = _homography(warp_a).dot(points)
+    b = _homography(warp_b).dot(points)
+    return float(np.hypot(*(a[:2] / a[2] - b[:2] / b[2])).max())
+
+
+def rig_warp_matrices(capture, ref_index, warp_mode=cv2.MOTION_HOMOGRAPHY):
+    """
+    Band warp matrices derived from the rig relatives and intrinsics in the
+    image metadata (Capture.get_warp_matrices), as float32 3x3 homographies
+    or, for the other warp modes, their 2x3 affine part
+    """
+    warps = [np.asarray(w, dtype=np.float32) for w in capture.get_warp_matrices(ref_index)]
+    if warp_mode != cv2.MOTION_HOMOGRAPHY:
+        warps = [w[:2] for w in warps]
+    return warps
+
+
+def refine_warp_matrices(capture, warp_matrices, ref_index, warp_mode=cv2.MOTION_HOMOGRAPHY,
+                         scale=0.25, max_iterations=50, epsilon_threshold=1e-4):
+    """
+    A single low resolution, few iteration ECC pass on the gradient images of
+    each non reference, non LWIR band, starting from warp_matrices.
+    The reference is cropped to the inside of its undistortion border and the
+    band's border is masked out, so the black borders do not hold ECC near
+    its starting warp.
+
+    Returns
+    -------
+
+    the refined warp matrices and a dict of {band index: ECC correlation},
+    bands where ECC fails to converge keep their starting matrix
+    """
+    S = np.diag([scale, scale, 1.0]).astype(np.float32)
+    S_inv = np.diag([1.0 / scale, 1.0 / scale, 1.0]).astype(np.float32)
+    rows = 3 if warp_mode == cv2.MOTION_HOMOGRAPHY else 2
+    criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, max_iterations, epsilon_threshold)
+
+    ref, ref_valid = _edges(capture.images[ref_index], scale)
+    left, top, w, h = _inner_rect(ref_valid)
+    ref = np.ascontiguousarray(ref[top:top+h, left:left+w])
+    # template crop pixel -> reference pixel
+    T = np.array([[1, 0, left], [0, 1, top], [0, 0, 1]], dtype=np.float32)
+    T_inv = np.array([[1, 0, -left], [0, 1, -top], [0, 0, 1]], dtype=np.float32)
+    refined = [np.array(w, dtype=np.float32) for w in warp_matrices]
+    eccs = {}
+    for i, img in enumerate(capture.images):
+        if i == ref_index or img.band_name == 'LWIR':
+            continue
+        start = S.dot(_homography(refined[i]).astype(np.float32)).dot(S_inv).dot(T)
+        edges, valid = _edges(img, scale)
+        try:
+            cc, warp = cv2.findTransformECC(ref, edges, np.ascontiguousarray(start[:rows]),
+                                            warp_mode, criteria, valid, 1)
+        except cv2.error:
+            continue
+        eccs[i] = float(cc)
+        warp = _homography(warp).astype(np.float32).dot(T_inv)
+        refined[i] = (S_inv.dot(warp).dot(S) / warp[2, 2])[:rows]
+    return refined, eccs
+
+
+def rig_registration(capture, ref_index, warp_mode=cv2.MOTION_HOMOGRAPHY, refine=True, scale=0.25,
+                     max_iterations=50):
+    """
+    Band registration from the metadata rig relatives, optionally refined by
+    refine_warp_matrices - milliseconds instead of a full ECC alignment for
+    cameras with a good factory calibration
+
+    Returns
+    -------
+
+    warp_matrices and a report of {band index: {'score': registration score,
+    'ecc': ECC correlation of the refinement, 'residual_px': how far the
+    refinement moved the rig relatives alignment}} for the checked bands
+    """
+    warp_matrices = rig_warp_matrices(capture, ref_index, warp_mode)
+    eccs = {}
+    if refine:
+        rig = warp_matrices
+        warp_matrices, eccs = refine_warp_matrices(capture, rig, ref_index, warp_mode, scale,
+                                                   max_iterations)
+    scores = registration_scores(capture, warp_matrices, ref_index, scale)
+    size = capture.images[ref_index].size()
+    report = {}
+    for i, score in scores.items():
+        report[i] = {'score': score, 'ecc': eccs.get(i),
+                     'residual_px': warp_displacement(rig[i], warp_matrices[i], size) if refine else None}
+    return warp_matrices, report
+
+
+def format_report(report):
+    """ One line per band summary of a rig_registration or robust_alignment report """
+    lines = []
+    for i in sorted(report):
+        r = report[i]
+        line = 'Band {}:'.format(i)
+        if r.get('score') is not None:
+            line += ' score {:.3f}'.format(r['score'])
+        if r.get('ecc') is not None:
+            line += ' ECC {:.3f}'.format(r['ecc'])
+        if r.get('residual_px') is not None:
+            line += ' residual {:.2f} px'.format(r['residual_px'])
+        if r.get('agreement_px') is not None:
+            line += ' agreement {:.2f} px'.format(r['agreement_px'])
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def _thread_map(func, items, n_jobs):
+    if n_jobs is None or n_jobs < 1:
+        n_jobs = os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        return list(pool.map(func, items))
+
+
+def texture_score(capture, band=0, scale=0.125):
+    """
+    Texture of a capture as the mean gradient magnitude of one band's raw
+    image at scale resolution, relative to its median level - featureless
+    water, sky or blurred captures score low, whatever their sensor noise
+    """
+    small = cv2.resize(capture.images[band].raw(), None, fx=scale, fy=scale,
+                       interpolation=cv2.INTER_AREA).astype(np.float32)
+    grad = cv2.addWeighted(np.absolute(cv2.Sobel(small, cv2.CV_32F, 1, 0, ksize=3)), 0.5,
+                           np.absolute(cv2.Sobel(small, cv2.CV_32F, 0, 1, ksize=3)), 0.5, 0)
+    return float(grad.mean() / max(np.median(small), 1.0))
+
+
+def select_alignment_captures(captures, n=3, band=0, max_candidates=64, n_jobs=-1):
+    """
+    The n captures best suited to band alignment, by texture_score of up to
+    max_candidates captures spread evenly over the flight, scored in parallel
+    on n_jobs threads (-1 for one per core)
+
+    Returns
+    -------
+
+    the chosen captures, best first, and their scores
+    """
+    bands = max(len(cap.images) for cap in captures)
+    complete = [cap for cap in captures if len(cap.images) == bands]
+    step = max(1, len(complete) // max_candidates)
+    candidates = complete[::step][:max_candidates]
+
+    def score(cap):
+        try:
+            return texture_score(cap, band)
+        finally:
+            cap.clear_image_data()
+
+    scores = _thread_map(score, candidates, n_jobs)
+    order = np.argsort(scores)[::-1][:n]
+    return [candidates[i] for i in order], [scores[i] for i in order]
+
+
+def robust_alignment(captures, ref_index, warp_mode=cv2.MOTION_HOMOGRAPHY, max_iterations=2500,
+                     n_jobs=-1, adaptive=False):
+    """
+    Align each capture (imageutils.align_capture) concurrently on n_jobs
+    threads and combine the warp sets into their element wise median. A
+    capture ECC fails to converge on is left out of the median; a
+    RuntimeError is raised only when none of them align
+
+    Returns
+    -------
+
+    the median warp_matrices and a report of {band index: {'ecc': median ECC
+    correlation, 'agreement_px': largest distance between a capture's warp
+    and the median warp}} for the aligned bands - small agreement values
+    mean the captures agree on the registration
+    """
+    def align_one(cap):
+        try:
+            return imageutils.align_capture(cap, ref_index=ref_index, warp_mode=warp_mode,
+                                            max_iterations=max_iterations, adaptive=adaptive)
+        except cv2.error as e:
+            return e
+
+    results = _thread_map(align_one, captures, n_jobs)
+    failed = [r for r in results if isinstance(r, cv2.error)]
+    results = [r for r in results if not isinstance(r, cv2.error)]
+    if not results:
+        raise RuntimeError("none of the {} alignment captures aligned".format(len(captures))) from failed[-1]
+    if failed:
+        print("{} of {} alignment captures did not align and were left out".format(len(failed), len(captures)))
+    rows = 3 if warp_mode == cv2.MOTION_HOMOGRAPHY else 2
+    sets = [[_homography(w) / _homography(w)[2, 2] for w in warps] for warps, _ in results]
+    median = [np.median([s[b] for s in sets], axis=0) for b in range(len(sets[0]))]
+    size = captures[0].images[ref_index].size()
+    report = {}
+    for b, img in enumerate(captures[0].images):
+        if b == ref_index or img.band_name == 'LWIR':
+            continue
+        eccs = [pair['ecc'] for _, pairs in results for pair in pairs
+                if pair['match_index'] == b and pair.get('ecc') is not None]
+        report[b] = {'ecc': float(np.median(eccs)) if eccs else None,
+                     'agreement_px': max(warp_displacement(s[b], median[b], size) for s in sets)}
+    return [m[:rows].astype(np.float32) for m in median], report
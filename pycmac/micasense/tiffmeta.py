@@ -0,0 +1,407 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Native TIFF Metadata Reader/Writer
+
+    In-process reader/writer for the TIFF tags and embedded XMP packet of
+    MicaSense RedEdge/Altum imagery.
+
+    get_metadata returns a dict keyed like the output of exiftool -G -n (e.g.
+    'EXIF:BlackLevel', 'XMP:RadiometricCalibration') so it can be handed to
+    pycmac.micasense.metadata.Metadata in place of an exiftool record.
+
+Copyright 2017 MicaSense, Inc.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy of
+this software and associated documentation files (the "Software"), to deal in the
+Software without restriction, including without limitation the rights to use,
+copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the
+Software, and to permit persons to whom the Software is furnished to do so,
+subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""
+import re
+import struct
+from fractions import Fraction
+import xml.etree.ElementTree as ET
+import numpy as np
+
+# TIFF field type: (struct format, size in bytes)
+_TYPES = {1: ('B', 1), 2: ('s', 1), 3: ('H', 2), 4: ('I', 4), 5: ('II', 8),
+          6: ('b', 1), 7: ('s', 1), 8: ('h', 2), 9: ('i', 4), 10: ('ii', 8),
+          11: ('f', 4), 12: ('d', 8), 13: ('I', 4)}
+
+EXIF_IFD_POINTER = 34665
+GPS_IFD_POINTER = 34853
+XMP_TAG = 700
+
+# tags describing the pixel layout, always written from the array itself
+_LAYOUT_TAGS = (254, 256, 257, 258, 259, 262, 273, 277, 278, 279, 284, 317,
+                322, 323, 324, 325, 338, 339)
+
+# the descriptive tags copied onto processed outputs by output_tags, anything
+# else (palettes, JPEG/YCbCr tables, predictors, offsets into the source file,
+# maker notes) describes the source's own encoding or layout
+_IFD0_OUTPUT_TAGS = frozenset([
+    269, 270, 271, 272, 274, 282, 283, 296, 305, 306, 315, 316, 33432,
+    50706, 50708, 50735])
+
+_EXIF_OUTPUT_TAGS = frozenset([
+    33434, 33437, 34850, 34855, 34864, 34867, 36864, 36867, 36868, 36880,
+    36881, 36882, 37377, 37378, 37379, 37380, 37381, 37382, 37383, 37384,
+    37385, 37386, 37510, 37520, 37521, 37522, 40960, 40961, 40962, 40963,
+    41486, 41487, 41488, 41495, 41728, 41729, 41985, 41986, 41987, 41988,
+    41989, 41990, 41992, 41993, 41994, 41996, 42016, 42032, 42033, 42034,
+    42035, 42036, 42037])
+
+# GPSVersionID to GPSHPositioningError, every GPS tag is descriptive
+_GPS_OUTPUT_TAGS = frozenset(range(32))
+
+# the tags Metadata reads, named as exiftool names them
+_IFD0_TAGS = {256: 'ImageWidth', 257: 'ImageHeight', 258: 'BitsPerSample',
+              271: 'Make', 272: 'Model', 274: 'Orientation', 305: 'Software',
+              306: 'ModifyDate', 50714: 'BlackLevel'}
+
+_EXIF_TAGS = {33434: 'ExposureTime', 33437: 'FNumber', 34855: 'ISO',
+              34867: 'ISOSpeed', 36867: 'DateTimeOriginal',
+              37386: 'FocalLength', 37520: 'SubSecTime', 37521: 'SubSecTimeOriginal',
+              41486: 'FocalPlaneXResolution', 41487: 'FocalPlaneYResolution',
+              41488: 'FocalPlaneResolutionUnit', 42033: 'SerialNumber'}
+
+_GPS_TAGS = {1: 'GPSLatitudeRef', 2: 'GPSLatitude', 3: 'GPSLongitudeRef',
+             4: 'GPSLongitude', 5: 'GPSAltitudeRef', 6: 'GPSAltitude',
+             11: 'GPSDOP'}
+
+_RDF = '{http://www.w3.org/1999/02/22-rdf-syntax-ns#}'
+
+# exiftool's JSON writer only emits values matching this as numbers
+_JSON_NUMBER = re.compile(r'^-?(\d|[1-9]\d{1,14})(\.\d{1,16})?(e[-+]?\d{1,3})?$', re.I)
+
+
+def _decode(ttype, count, raw, bo):
+    fmt, size = _TYPES[ttype]
+    if ttype == 2:
+        return raw[:count].split(b'\0', 1)[0].decode('utf-8', 'ignore')
+    if ttype in (1, 7):
+        return bytes(raw[:count])
+    vals = struct.unpack(bo + fmt * count, raw[:size * count])
+    if ttype in (5, 10):
+        return tuple(zip(vals[0::2], vals[1::2]))
+    return vals
+
+
+def _read_ifd(fh, offset, bo):
+    fh.seek(offset)
+    n, = struct.unpack(bo + 'H', fh.read(2))
+    data = fh.read(12 * n)
+    entries = {}
+    for i in range(n):
+        tag, ttype, count, value = struct.unpack(bo + 'HHI4s', data[12*i:12*i+12])
+        if ttype not in _TYPES:
+            continue
+        nbytes = _TYPES[ttype][1] * count
+        if nbytes > 4:
+            off, = struct.unpack(bo + 'I', value)
+            fh.seek(off)
+            raw = fh.read(nbytes)
+        else:
+            raw = value
+        entries[tag] = (ttype, _decode(ttype, count, raw, bo))
+    return entries
+
+
+def read_tiff_tags(path):
+    """
+    Read the tags of the first IFD of a TIFF and of its EXIF and GPS sub-IFDs
+
+    Parameters
+    ----------
+
+    path: string
+          path to a (classic, not Big-) TIFF
+
+    Returns
+    -------
+
+    dict of {'IFD0': entries, 'ExifIFD': entries, 'GPS': entries} where
+    entries map tag number -> (tiff type, decoded value)
+    """
+    with open(path, 'rb') as fh:
+        header = fh.read(8)
+        if header[:4] == b'II*\x00':
+            bo = '<'
+        elif header[:4] == b'MM\x00*':
+            bo = '>'
+        else:
+            raise IOError("Not a classic TIFF file: {}".format(path))
+        offset, = struct.unpack(bo + 'I', header[4:8])
+        ifds = {'IFD0': _read_ifd(fh, offset, bo)}
+        for name, pointer in (('ExifIFD', EXIF_IFD_POINTER), ('GPS', GPS_IFD_POINTER)):
+            entry = ifds['IFD0'].get(pointer)
+            if entry is not None:
+                ifds[name] = _read_ifd(fh, entry[1][0], bo)
+    return ifds
+
+
+def _ratio(pair):
+    num, den = pair
+    return float(num) / den if den != 0 else 0.0
+
+
+def _exif_value(ttype, value):
+    """ mimic the -n value exiftool reports for a decoded tag """
+    if ttype == 2:
+        return value.strip()
+    if ttype == 7:
+        return value
+    if ttype == 1:
+        value = tuple(bytearray(value))
+    elif ttype in (5, 10):
+        value = [_ratio(v) for v in value]
+    if len(value) == 1:
+        return value[0]
+    return ' '.join(str(v) for v in value)
+
+
+def _xmp_value(text):
+    text = text.strip()
+    if _JSON_NUMBER.match(text):
+        if re.match(r'^-?\d+$', text):
+            return int(text)
+        return float(text)
+    return text
+
+
+def _local(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def parse_xmp(packet):
+    """
+    Flatten an XMP packet into 'XMP:<Name>' keys the way exiftool -G -n does
+    for the MicaSense Camera, DLS and MicaSense namespaces. rdf containers
+    become lists, everything else a number or string.
+    """
+    packet = packet.strip(b'\x00 \t\r\n')
+    if not packet:
+        return {}
+    root = ET.fromstring(packet)
+    meta = {}
+    for desc in root.iter(_RDF + 'Description'):
+        for key, val in desc.attrib.items():
+            if key.startswith('{') and not key.startswith(_RDF):
+                meta['XMP:' + _local(key)] = _xmp_value(val)
+        for child in desc:
+            if child.tag.startswith(_RDF):
+                continue
+            container = [c for c in child if c.tag in (_RDF + 'Seq', _RDF + 'Bag', _RDF + 'Alt')]
+            if container:
+                items = [_xmp_value(li.text or '') for li in container[0]]
+                if container[0].tag == _RDF + 'Alt':
+                    items = items[:1]
+                    meta['XMP:' + _local(child.tag)] = items[0] if items else ''
+                else:
+                    meta['XMP:' + _local(child.tag)] = items
+            elif child.text is not None and child.text.strip():
+                meta['XMP:' + _local(child.tag)] = _xmp_value(child.text)
+    return meta
+
+
+def get_metadata(path):
+    """
+    Read the metadata of a MicaSense TIFF without exiftool
+
+    Parameters
+    ----------
+
+    path: string
+          path to the image
+
+    Returns
+    -------
+
+    dict keyed like an exiftool -G -n record
+    """
+    ifds = read_tiff_tags(path)
+    meta = {'SourceFile': path}
+    for group, names in (('IFD0', _IFD0_TAGS), ('ExifIFD', _EXIF_TAGS), ('GPS', _GPS_TAGS)):
+        for tag, (ttype, value) in ifds.get(group, {}).items():
+            name = names.get(tag)
+            if name is None:
+                continue
+            if name in ('GPSLatitude', 'GPSLongitude') and ttype == 5:
+                # exiftool -n reports decimal degrees
+                meta['EXIF:' + name] = sum(_ratio(v) / 60.0**i for i, v in enumerate(value))
+            elif ttype != 7:
+                meta['EXIF:' + name] = _exif_value(ttype, value)
+    xmp = ifds['IFD0'].get(XMP_TAG)
+    if xmp is not None:
+        meta.update(parse_xmp(xmp[1]))
+    return meta
+
+
+def get_metadata_batch(paths):
+    """ Read the metadata of several files, see get_metadata """
+    return [get_metadata(p) for p in paths]
+
+
+def _encode(ttype, values, bo):
+    """ pack a tag value, returning (bytes, count) """
+    if ttype == 2:
+        raw = (values.encode('utf-8') if not isinstance(values, bytes) else values) + b'\0'
+        return raw, len(raw)
+    if ttype in (1, 7) and isinstance(values, (bytes, bytearray)):
+        return bytes(values), len(values)
+    if not isinstance(values, (tuple, list)):
+        values = (values,)
+    fmt = _TYPES[ttype][0]
+    if ttype in (5, 10):
+        flat = []
+        for v in values:
+            if not isinstance(v, tuple):
+                f = Fraction(v).limit_denominator(1000000)
+                v = (f.numerator, f.denominator)
+            flat.extend(v)
+        return struct.pack(bo + fmt * len(values), *flat), len(values)
+    return struct.pack(bo + fmt * len(values), *values), len(values)
+
+
+def _pack_ifd(entries, offset, bo):
+    """ pack an IFD at offset, followed by its out-of-line values """
+    tags = sorted(entries)
+    data_off = offset + 2 + 12 * len(tags) + 4
+    fields = [struct.pack(bo + 'H', len(tags))]
+    extra = bytearray()
+    for tag in tags:
+        ttype, values = entries[tag]
+        raw, count = _encode(ttype, values, bo)
+        if len(raw) <= 4:
+            field = raw.ljust(4, b'\0')
+        else:
+            field = struct.pack(bo + 'I', data_off + len(extra))
+            extra += raw
+            if len(extra) % 2:
+                extra += b'\0'
+        fields.append(struct.pack(bo + 'HHI', tag, ttype, count) + field)
+    fields.append(struct.pack(bo + 'I', 0))
+    return b''.join(fields) + bytes(extra)
+
+
+def write_tiff(path, data, ifd0=None, exif=None, gps=None, xmp=None, photometric=None):
+    """
+    Write an uncompressed single-strip TIFF with its tags in one pass
+
+    Parameters
+    ----------
+
+    path: string
+          output file
+
+    data: np.array
+          (rows, cols) or (rows, cols, bands) uint8, uint16 or float32
+
+    ifd0, exif, gps: dict
+          tag number -> (tiff type, value) for the main, EXIF and GPS IFDs,
+          e.g. as returned by read_tiff_tags
+
+    xmp: bytes
+          an XMP packet to embed
+
+    photometric: int
+          TIFF photometric interpretation, defaults to RGB for 3 bands and
+          min-is-black otherwise
+    """
+    bo = '<'
+    data = np.ascontiguousarray(data)
+    data = data.astype(data.dtype.newbyteorder(bo), copy=False)
+    rows, cols = data.shape[:2]
+    spp = 1 if data.ndim == 2 else data.shape[2]
+    if photometric is None:
+        photometric = 2 if spp == 3 else 1
+    sample_format = 3 if data.dtype.kind == 'f' else (2 if data.dtype.kind == 'i' else 1)
+
+    entries = dict((t, v) for t, v in (ifd0 or {}).items()
+                   if t not in (EXIF_IFD_POINTER, GPS_IFD_POINTER) and t not in _LAYOUT_TAGS)
+    entries.update({256: (4, cols), 257: (4, rows),
+                    258: (3, (data.dtype.itemsize * 8,) * spp), 259: (3, 1),
+                    262: (3, photometric), 273: (4, 0), 277: (3, spp),
+                    278: (4, rows), 279: (4, data.nbytes), 284: (3, 1),
+                    339: (3, (sample_format,) * spp)})
+    extra_samples = spp - (3 if photometric == 2 else 1)
+    if extra_samples > 0:
+        entries[338] = (3, (0,) * extra_samples)
+    if xmp is not None:
+        entries[XMP_TAG] = (1, xmp)
+    if exif:
+        entries[EXIF_IFD_POINTER] = (4, 0)
+    if gps:
+        entries[GPS_IFD_POINTER] = (4, 0)
+
+    # the size of an IFD does not depend on where it sits, so lay them out
+    # back to back and fill in the pointers afterwards
+    offset = 8 + len(_pack_ifd(entries, 0, bo))
+    blocks = []
+    for tag, sub in ((EXIF_IFD_POINTER, exif), (GPS_IFD_POINTER, gps)):
+        if sub:
+            offset += offset % 2
+            entries[tag] = (4, offset)
+            blocks.append((offset, sub))
+            offset += len(_pack_ifd(sub, offset, bo))
+    offset += offset % 2
+    entries[273] = (4, offset)
+
+    with open(path, 'wb') as fh:
+        fh.write(b'II*\x00' + struct.pack(bo + 'I', 8))
+        fh.write(_pack_ifd(entries, 8, bo))
+        for off, sub in blocks:
+            fh.write(b'\0' * (off - fh.tell()))
+            fh.write(_pack_ifd(sub, off, bo))
+        fh.write(b'\0' * (entries[273][1] - fh.tell()))
+        # straight from the array's buffer, without a bytes copy of the pixels
+        fh.write(memoryview(data).cast('B'))
+
+
+def output_tags(path, size=None):
+    """
+    The descriptive tags of the TIFF at path as write_tiff keyword arguments,
+    so that a processed copy carries the camera, EXIF, GPS and XMP (capture
+    id, band, rig) tags of its source image. Tags describing how the source
+    itself is encoded (ColorMap, JPEGTables, YCbCr, Predictor...) are left out.
+    Raises IOError for files read_tiff_tags can not parse (e.g. BigTIFF)
+
+    Parameters
+    ----------
+
+    path: string
+          the source image
+
+    size: tuple
+          (width, height) of the output, updates the EXIF image size tags
+
+    Returns
+    -------
+
+    dict of ifd0, exif, gps and xmp for write_tiff
+    """
+    ifds = read_tiff_tags(path)
+    ifd0 = dict((t, v) for t, v in ifds['IFD0'].items() if t in _IFD0_OUTPUT_TAGS)
+    xmp = ifds['IFD0'].get(XMP_TAG, (None, None))[1]
+    if isinstance(xmp, str):
+        xmp = xmp.encode('utf-8')
+    exif = dict((t, v) for t, v in ifds.get('ExifIFD', {}).items() if t in _EXIF_OUTPUT_TAGS)
+    if size is not None:
+        # ExifImageWidth, ExifImageHeight
+        for tag, value in ((40962, size[0]), (40963, size[1])):
+            if tag in exif:
+                exif[tag] = (4, int(value))
+    gps = dict((t, v) for t, v in ifds.get('GPS', {}).items() if t in _GPS_OUTPUT_TAGS)
+    return {'ifd0': ifd0, 'exif': exif, 'gps': gps, 'xmp': xmp}
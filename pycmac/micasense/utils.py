@@ -19,15 +19,343 @@ IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
 CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 """
 
+import os
 import cv2
 import numpy as np
+import threading
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+def map_bands(func, items, n_jobs=None):
+    ''' [func(item) for item in items], run on up to n_jobs threads when
+    n_jobs is not None or 1 (-1 for one per core). Meant for the bands of a
+    capture, whose OpenCV and NumPy work releases the GIL. '''
+    items = list(items)
+    if n_jobs is None or n_jobs == 1 or len(items) < 2:
+        return [func(item) for item in items]
+    if n_jobs < 1:
+        n_jobs = os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=min(n_jobs, len(items))) as pool:
+        return list(pool.map(func, items))
+
+
+# resident memory of a worker process before it touches any imagery
+WORKER_OVERHEAD = 200 * 2**20
+
+
+def available_memory():
+    ''' Bytes of memory available for new work: MemAvailable of /proc/meminfo
+    on Linux, otherwise the free physical pages from sysconf, None if unknown '''
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def capture_peak_bytes(width, height, bands, dtype=np.float32):
+    ''' Rough peak memory of taking one capture to aligned composites: per band
+    the uint16 raw, the reflectance and undistorted images in dtype and the
+    float32 warped image, plus the float32 aligned and display stacks '''
+    itemsize = np.dtype(dtype).itemsize
+    return width * height * (bands * (2 + 2 * itemsize + 4) + 2 * bands * 4)
+
+
+def auto_workers(per_worker, n_jobs=-1, processes=True, reserve=0.2, shared=0):
+    ''' Number of workers to run: n_jobs when positive, otherwise as many as
+    fit in the available memory (keeping a reserve fraction free, less shared
+    bytes used once whatever the number of workers, e.g. a cache threads share)
+    at per_worker bytes each, plus WORKER_OVERHEAD for processes, between 1
+    and the cpu count '''
+    if n_jobs is not None and n_jobs > 0:
+        return n_jobs
+    cores = os.cpu_count() or 1
+    available = available_memory()
+    if available is None:
+        return cores
+    if processes:
+        per_worker += WORKER_OVERHEAD
+    return int(max(1, min(cores, (available * (1 - reserve) - shared) // max(per_worker, 1))))
+
+
+class LRUCache(object):
+    ''' Thread-safe least-recently-used mapping bounded by number of entries
+    and/or by the total nbytes of the stored arrays '''
+    def __init__(self, max_entries=None, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, nbytes = self._items.pop(key)
+            except KeyError:
+                return default
+            self._items[key] = (value, nbytes)
+            return value
+
+    def put(self, key, value, nbytes=None):
+        if nbytes is None:
+            nbytes = getattr(value, 'nbytes', 0)
+        with self._lock:
+            if key in self._items:
+                self.nbytes -= self._items.pop(key)[1]
+            self._items[key] = (value, nbytes)
+            self.nbytes += nbytes
+            self._evict()
+        return value
+
+    def _evict(self):
+        while self._items and ((self.max_entries is not None and len(self._items) > self.max_entries) or
+                               (self.max_bytes is not None and self.nbytes > self.max_bytes)):
+            _, (_, evicted) = self._items.popitem(last=False)
+            self.nbytes -= evicted
+
+    def resize(self, max_entries=None, max_bytes=None):
+        ''' Change the bounds, evicting least recently used entries to fit '''
+        with self._lock:
+            self.max_entries = max_entries
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def items(self):
+        ''' Snapshot of the (key, value) pairs, least recently used first '''
+        with self._lock:
+            return [(key, value) for key, (value, _) in self._items.items()]
+
+    def pop(self, key, default=None):
+        with self._lock:
+            try:
+                value, nbytes = self._items.pop(key)
+            except KeyError:
+                return default
+            self.nbytes -= nbytes
+            return value
+
+    def pop_matching(self, predicate):
+        ''' Remove every entry whose key satisfies predicate '''
+        with self._lock:
+            for key in [key for key in self._items if predicate(key)]:
+                self.nbytes -= self._items.pop(key)[1]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.nbytes = 0
+
+
+class BufferPool(object):
+    ''' Thread-safe free list of arrays by shape and dtype, so that per capture
+    scratch and output arrays are recycled rather than reallocated.
+    acquire() hands out a free array (contents undefined) or a new one,
+    release() returns arrays for reuse once nothing refers to them anymore,
+    arrays the pool did not allocate are ignored. At most max_free arrays of
+    each shape and dtype are kept. '''
+    def __init__(self, max_free=8):
+        self.max_free = max_free
+        self.allocated = 0
+        self._free = {}
+        self._owned = weakref.WeakValueDictionary()
+        self._lock = threading.Lock()
+
+    def acquire(self, shape, dtype=np.float32):
+        key = (tuple(shape), np.dtype(dtype).str)
+        with self._lock:
+            free = self._free.get(key)
+            if free:
+                return free.pop()
+            self.allocated += 1
+        a = np.empty(key[0], dtype=key[1])
+        with self._lock:
+            self._owned[id(a)] = a
+        return a
+
+    def release(self, *arrays):
+        with self._lock:
+            for a in arrays:
+                if self._owned.get(id(a)) is not a:
+                    continue
+                free = self._free.setdefault((a.shape, a.dtype.str), [])
+                if len(free) < self.max_free:
+                    free.append(a)
+
+    def clear(self):
+        with self._lock:
+            self._free.clear()
+
+
+# vignette and vignette x row-gradient maps, shared by every image of a band
+_correction_maps = LRUCache(max_entries=64)
+
+
+def vignette_array(vignette_center, vignette_polynomial, shape):
+    ''' Cached float32 (rows, cols) vignette correction map, in image orientation.
+    Multiply a (black level subtracted) image by it to correct optical vignetting. '''
+    key = ('vignette', tuple(vignette_center), tuple(vignette_polynomial), tuple(shape))
+    vignette = _correction_maps.get(key)
+    if vignette is None:
+        # reverse list and append 1., so that we can call with numpy polyval
+        v_poly_list = list(vignette_polynomial)
+        v_poly_list.reverse()
+        v_poly_list.append(1.)
+        rows, cols = shape
+        x = np.arange(cols, dtype=np.float64) - vignette_center[0]
+        y = np.arange(rows, dtype=np.float64)[:, None] - vignette_center[1]
+        r = np.hypot(x, y)
+        vignette = (1. / np.polyval(np.array(v_poly_list), r)).astype(np.float32)
+        vignette.setflags(write=False)
+        _correction_maps.put(key, vignette)
+    return vignette
+
+
+def row_gradient(a2, a3, exposure_time, rows):
+    ''' Row gradient correction factor of each image row, as a (rows, 1) column '''
+    y = np.arange(rows, dtype=np.float64)[:, None]
+    return 1.0 / (1.0 + a2 * y / exposure_time - a3 * y)
+
+
+def correction_map(vignette_center, vignette_polynomial, a2, a3, exposure_time, shape, band=None):
+    ''' Cached float32 (rows, cols) product of the vignette and row gradient
+    corrections. These only depend on the band calibration, exposure and image
+    size, so one map serves every image of a band with the same exposure. '''
+    key = ('correction', band, tuple(vignette_center), tuple(vignette_polynomial),
+           a2, a3, exposure_time, tuple(shape))
+    corr = _correction_maps.get(key)
+    if corr is None:
+        corr = vignette_array(vignette_center, vignette_polynomial, shape) * \
+               row_gradient(a2, a3, exposure_time, shape[0]).astype(np.float32)
+        corr.setflags(write=False)
+        _correction_maps.put(key, corr)
+    return corr
+
+
+# undistortion remap tables, identical for every image sharing the intrinsics
+_undistort_maps = LRUCache(max_entries=32)
+
+# use cv2.convertMaps fixed-point (CV_16SC2) tables by default, faster to remap
+# with but with 1/32 px coordinate precision
+FIXED_POINT_REMAP = False
+
+
+def _intrinsics_key(camera_matrix, distortion_coeffs, size):
+    return (np.asarray(camera_matrix, dtype=np.float64).tobytes(),
+            np.asarray(distortion_coeffs, dtype=np.float64).tobytes(),
+            tuple(int(v) for v in size))
+
+
+def optimal_camera_matrix(camera_matrix, distortion_coeffs, size):
+    ''' Cached cv2.getOptimalNewCameraMatrix (alpha 1) of the given intrinsics '''
+    key = ('camera',) + _intrinsics_key(camera_matrix, distortion_coeffs, size)
+    new_cam_mat = _undistort_maps.get(key)
+    if new_cam_mat is None:
+        new_cam_mat, _ = cv2.getOptimalNewCameraMatrix(camera_matrix, distortion_coeffs,
+                                                       tuple(size), 1)
+        new_cam_mat.setflags(write=False)
+        _undistort_maps.put(key, new_cam_mat)
+    return new_cam_mat
+
+
+def undistort_maps(camera_matrix, distortion_coeffs, size, fixed_point=None):
+    ''' Cached cv2.remap tables undistorting images of the given intrinsics and
+    (width, height) size onto optimal_camera_matrix.
+    If fixed_point (default FIXED_POINT_REMAP) the float maps are converted
+    to the CV_16SC2 + CV_16UC1 pair by cv2.convertMaps '''
+    if fixed_point is None:
+        fixed_point = FIXED_POINT_REMAP
+    key = ('maps', fixed_point) + _intrinsics_key(camera_matrix, distortion_coeffs, size)
+    maps = _undistort_maps.get(key)
+    if maps is None:
+        new_cam_mat = optimal_camera_matrix(camera_matrix, distortion_coeffs, size)
+        map1, map2 = cv2.initUndistortRectifyMap(camera_matrix,
+                                                 distortion_coeffs,
+                                                 np.eye(3),
+                                                 new_cam_mat,
+                                                 tuple(size),
+                                                 cv2.CV_32F) # cv2.CV_32F for 32 bit floats
+        if fixed_point:
+            map1, map2 = cv2.convertMaps(map1, map2, cv2.CV_16SC2)
+        map1.setflags(write=False)
+        map2.setflags(write=False)
+        maps = (map1, map2)
+        _undistort_maps.put(key, maps, map1.nbytes + map2.nbytes)
+    return maps
+
+
+def registration_maps(camera_matrix, distortion_coeffs, size, warp_matrix, warp_mode,
+                      cropped_dimensions, fixed_point=None):
+    ''' Cached cv2.remap tables taking a raw (distorted) band of the given
+    intrinsics and (width, height) size straight to the registered and
+    cropped frame, i.e. undistortion, the inverse map warp_matrix of
+    warp_mode and the (left, top, w, h) crop offset folded into one lookup.
+    See undistort_maps for fixed_point '''
+    if fixed_point is None:
+        fixed_point = FIXED_POINT_REMAP
+    left, top, w, h = (int(v) for v in cropped_dimensions)
+    warp_matrix = np.asarray(warp_matrix, dtype=np.float64)
+    key = ('registration', fixed_point, warp_matrix.tobytes(), int(warp_mode),
+           (left, top, w, h)) + _intrinsics_key(camera_matrix, distortion_coeffs, size)
+    maps = _undistort_maps.get(key)
+    if maps is None:
+        # cropped pixel -> registered frame -> undistorted band pixel
+        x, y = np.meshgrid(np.arange(left, left + w, dtype=np.float64),
+                           np.arange(top, top + h, dtype=np.float64))
+        pts = np.stack([x.ravel(), y.ravel(), np.ones(x.size)])
+        und = np.dot(warp_matrix, pts)
+        if warp_mode == cv2.MOTION_HOMOGRAPHY:
+            und = und[:2] / und[2]
+        # undistorted pixel -> normalised ray -> distorted (raw) pixel, as
+        # cv2.initUndistortRectifyMap does for every pixel of the frame
+        new_cam_mat = optimal_camera_matrix(camera_matrix, distortion_coeffs, size)
+        rays = np.dot(np.linalg.inv(new_cam_mat), np.vstack([und, np.ones(und.shape[1])]))
+        raw, _ = cv2.projectPoints(rays.T.reshape(-1, 1, 3), np.zeros(3), np.zeros(3),
+                                   np.asarray(camera_matrix, dtype=np.float64),
+                                   np.asarray(distortion_coeffs, dtype=np.float64))
+        raw = raw.reshape(h, w, 2).astype(np.float32)
+        map1, map2 = np.ascontiguousarray(raw[:, :, 0]), np.ascontiguousarray(raw[:, :, 1])
+        if fixed_point:
+            map1, map2 = cv2.convertMaps(map1, map2, cv2.CV_16SC2)
+        map1.setflags(write=False)
+        map2.setflags(write=False)
+        maps = (map1, map2)
+        _undistort_maps.put(key, maps, map1.nbytes + map2.nbytes)
+    return maps
+
+
+def undistort_state():
+    ''' The cached camera matrices and remap tables as a picklable list,
+    e.g. to hand to worker processes, see load_undistort_state '''
+    return _undistort_maps.items()
+
+
+def load_undistort_state(state):
+    ''' Seed the undistortion cache with the undistort_state() of another process '''
+    for key, value in state:
+        arrays = value if isinstance(value, tuple) else (value,)
+        for a in arrays:
+            a.setflags(write=False)
+        _undistort_maps.put(key, value, sum(a.nbytes for a in arrays))
 
 
 def raw_image_to_radiance(meta, imageRaw):
     # get image dimensions
-    imageRaw = imageRaw.T
-    xDim = imageRaw.shape[0]
-    yDim = imageRaw.shape[1]
+    rows, cols = imageRaw.shape
 
     #  get radiometric calibration factors
 
@@ -49,14 +377,16 @@ def raw_image_to_radiance(meta, imageRaw):
 
     # apply image correction methods to raw image
     # step 1 - row gradient correction, vignette & radiometric calibration:
-    # compute the vignette map image
-    V, x, y = vignette_map(meta, xDim, yDim)
-
-    # row gradient correction
-    R = 1.0 / (1.0 + a2 * y / exposureTime - a3 * y)
+    # the vignette and row gradient maps are cached per band and exposure
+    vignetteCenter = [float(v) for v in meta.get_item('XMP:VignettingCenter')]
+    vignettePoly = [float(v) for v in meta.get_item('XMP:VignettingPolynomial')]
+    V = vignette_array(vignetteCenter, vignettePoly, (rows, cols))
+    R = np.broadcast_to(row_gradient(a2, a3, exposureTime, rows), (rows, cols))
+    corr = correction_map(vignetteCenter, vignettePoly, a2, a3, exposureTime, (rows, cols),
+                          band=meta.get_item('XMP:RigCameraIndex'))
 
     # subtract the dark level and adjust for vignette and row gradient
-    L = V * R * (imageRaw - darkLevel)
+    L = (imageRaw - darkLevel) * corr
 
     # Floor any negative radiances to zero (can happend due to noise around blackLevel)
     L[L < 0] = 0
@@ -69,11 +399,11 @@ def raw_image_to_radiance(meta, imageRaw):
     # because coefficients are scaled to work with input values of max 1.0
     bitsPerPixel = meta.get_item('EXIF:BitsPerSample')
     bitDepthMax = float(2 ** bitsPerPixel)
-    radianceImage = L.astype(float) / (gain * exposureTime) * a1 / bitDepthMax
+    radianceImage = L * (a1 / (gain * exposureTime * bitDepthMax))
 
     # return both the radiance compensated image and the DN corrected image, for the
     # sake of the tutorial and visualization
-    return radianceImage.T, L.T, V.T, R.T
+    return radianceImage, L, V, R
 
 
 def vignette_map(meta, xDim, yDim):
@@ -85,12 +415,6 @@ def vignette_map(meta, xDim, yDim):
     NvignettePoly = meta.size('XMP:VignettingPolynomial')
     vignettePolyList = [float(meta.get_item('XMP:VignettingPolynomial', i)) for i in range(NvignettePoly)]
 
-    # reverse list and append 1., so that we can call with numpy polyval
-    vignettePolyList.reverse()
-    vignettePolyList.append(1.)
-    vignettePoly = np.array(vignettePolyList)
-
-    # perform vignette correction
     # get coordinate grid across image
     x, y = np.meshgrid(np.arange(xDim), np.arange(yDim))
 
@@ -98,12 +422,8 @@ def vignette_map(meta, xDim, yDim):
     x = x.T
     y = y.T
 
-    # compute matrix of distances from image center
-    r = np.hypot((x - xVignette), (y - yVignette))
-
-    # compute the vignette polynomial for each distance - we divide by the polynomial so that the
-    # corrected image is image_corrected = image_original * vignetteCorrection
-    vignette = 1. / np.polyval(vignettePoly, r)
+    # the cached map is in image orientation, this returns it transposed like x and y
+    vignette = vignette_array([xVignette, yVignette], vignettePolyList, (yDim, xDim)).T
     return vignette, x, y
 
 
@@ -157,13 +477,7 @@ def correct_lens_distortion(meta, image):
     # dist_coeffs = np.array(k[0],k[1],p[0],p[1],k[2]])
     dist_coeffs = distortionParameters[[0, 1, 3, 4, 2]]
 
-    new_cam_mat, _ = cv2.getOptimalNewCameraMatrix(cam_mat, dist_coeffs, (w, h), 1)
-    map1, map2 = cv2.initUndistortRectifyMap(cam_mat,
-                                             dist_coeffs,
-                                             np.eye(3),
-                                             new_cam_mat,
-                                             (w, h),
-                                             cv2.CV_32F)  # cv2.CV_32F for 32 bit floats
+    map1, map2 = undistort_maps(cam_mat, dist_coeffs, (w, h))
     # compute the undistorted 16 bit image
     undistortedImage = cv2.remap(image, map1, map2, cv2.INTER_LINEAR)
     return undistortedImage
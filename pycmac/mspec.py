@@ -21,13 +21,17 @@ from pycmac.utilities import _copy_dataset_config
 
 import numpy as np
 import pycmac.micasense.imageset as imageset
+import pycmac.micasense.pipeline as pipeline
+import pycmac.micasense.utils as utils
+import pycmac.micasense.registration as registration
+import pycmac.micasense.metadata as metadata
+import multiprocessing
 from glob2 import glob
 import imageio
 import cv2
 from pycmac.micasense.panel import Panel
-from pycmac.micasense.image import Image
+from pycmac.micasense.image import Image, product_cache_budget
 from skimage import exposure, util
-from subprocess import call#, check_call
 from joblib import Parallel, delayed
 from tqdm import tqdm
 import gdal, ogr#, gdal_array
@@ -53,6 +57,9 @@ def slant_view_proc(folder, nt=-1):
     
     fileList = [os.path.split(i)[1] for i in fileList] 
     
+    # each worker holds two 8 bit 3 band composites and a band being read
+    nt = utils.auto_workers(ref.shape[0] * ref.shape[1] * (6 + ref.dtype.itemsize), nt)
+    
     fileList.sort()
     
     rgbdir = os.path.join(folder, "RGB")
@@ -76,29 +83,23 @@ def slant_view_proc(folder, nt=-1):
         for im in range(3,6):
             mspec[:,:,im-3] = cv2.imread(inList[im], cv2.IMREAD_LOAD_GDAL)    
             
-        outRgb = os.path.join(rgbdir, f)
-        imageio.imwrite(outRgb, rgb)    
-        
-        cmd1 = ["exiftool", "-tagsFromFile", inList[0],  "-file:all", "-iptc:all",
-           "-exif:all",  "-xmp", "-Composite:all", outRgb, 
-           "-overwrite_original"]
-        call(cmd1)
+        # the tags of the first band are written along with the pixels
+        tags = metadata.source_tags(inList[0], (ref.shape[1], ref.shape[0]))
         
+        outRgb = os.path.join(rgbdir, f)
+        metadata.write_tagged(outRgb, rgb, inList[0], tags, exiftoolPath)
         
         outMs = os.path.join(msdir, f)
-        imageio.imwrite(outMs, mspec)  
-        
-        cmd2 = ["exiftool", "-tagsFromFile", inList[0],  "-file:all", "-iptc:all",
-           "-exif:all",  "-xmp", "-Composite:all", outMs, 
-           "-overwrite_original"]
-        call(cmd2)
+        metadata.write_tagged(outMs, mspec, inList[0], tags, exiftoolPath)
     
     Parallel(n_jobs=nt, verbose=2)(delayed(_proc_my_pics)(file) for file in fileList)
     
 
 def mspec_proc(imgFolder, alIm, srFolder, precal=None, postcal=None, refBnd=4, 
                nt=-1, mx=100, stk=1, plots=False, panel_ref=None, 
-               warp_type='MH'):
+               warp_type='MH', watch=None, chunk_size=64, engine='joblib',
+               warp_cache=None, verify=True, align_mode='ecc', n_align=3,
+               interactive=True, adaptive=False):
     
     """
     
@@ -128,7 +129,8 @@ def mspec_proc(imgFolder, alIm, srFolder, precal=None, postcal=None, refBnd=4,
         
     alIm: string
              4 digit code of the image to align band images
-             e.g. "0023"
+             e.g. "0023", or None to pick the n_align best textured captures
+             of the flight and use the median of their alignments
         
     srFolder: string
                  path to directory for surface reflectance imagery
@@ -140,7 +142,8 @@ def mspec_proc(imgFolder, alIm, srFolder, precal=None, postcal=None, refBnd=4,
                 The band to which all others are aligned def 4 works best
             
     nt: int
-                No of threads to use   
+                No of threads to use, -1 sizes the number of workers from the
+                available memory and the expected peak memory of a capture
     
     mx: int
                 Max iterations for alignment (uses opencv motion homography)
@@ -165,6 +168,67 @@ def mspec_proc(imgFolder, alIm, srFolder, precal=None, postcal=None, refBnd=4,
             Either:
                 MH for MOTION_HOMOGRAPHY
                 Affine for MOTION_AFFINE
+    
+    watch: int
+    
+            If set, imgFolder may still be being copied to - captures are 
+            processed as they are completed and the function returns once no
+            new capture has appeared for this many seconds
+    
+    chunk_size: int
+    
+            Captures are handed to the workers this many at a time, with their
+            pixel data released after each chunk so memory stays flat
+    
+    engine: string
+    
+            How the captures are processed, either:
+                joblib - each capture read, processed and written by one of 
+                nt joblib workers
+                pipeline - reading, processing and writing overlap in 
+                separate stages (see micasense.pipeline) with nt compute 
+                threads, per stage throughput is printed at the end
+                threads - as joblib but with nt threads, nothing is pickled
+                warm - nt worker processes started once holding the warp 
+                matrices, irradiance and undistortion tables, only the file
+                paths of each capture are sent to them
+    
+    warp_cache: bool or string
+    
+            Where band alignments are kept per camera serial, firmware, warp
+            type, reference band and alignment settings: True for the default
+            location, a path, or None to always align (unless the
+            PYCMAC_WARP_CACHE path is set). An approved alignment is stored and
+            later runs with the same camera and settings reuse it without
+            aligning or prompting, unless an alignment image alIm is given
+    
+    verify: bool
+    
+            Check a cached alignment on the alignment image at low resolution
+            and realign if it scores below 0.8 of its stored score
+    
+    align_mode: string
+    
+            How the bands are registered when there is no cached alignment:
+                ecc - full resolution ECC pyramid alignment
+                rig - homographies from the metadata rig relatives
+                rig+ecc - rig relatives refined by a low resolution ECC pass
+            the rig modes print per band scores and residual misalignment
+    
+    n_align: int
+    
+            Number of captures aligned when alIm is None
+    
+    interactive: bool
+    
+            Ask for confirmation of a new band alignment, False accepts it
+            so unattended runs are not blocked
+    
+    adaptive: bool
+    
+            With align_mode ecc, align on a textured region of interest
+            coarse to fine, stopping once ECC plateaus, rather than the full
+            resolution ECC pyramid (default)
             
     """
     
@@ -217,7 +281,10 @@ def mspec_proc(imgFolder, alIm, srFolder, precal=None, postcal=None, refBnd=4,
         os.mkdir(srFolder)
     
     
-    imgset = imageset.ImageSet.from_directory(imagesFolder)
+    if watch is None:
+        imgset = imageset.ImageSet.from_directory(imagesFolder)
+        # the pipeline releases each capture itself once written
+        batches = imgset.iter_captures(chunk_size, release=engine != 'pipeline')
     
 
     
@@ -237,20 +304,83 @@ def mspec_proc(imgFolder, alIm, srFolder, precal=None, postcal=None, refBnd=4,
     # First we must find an image with decent features from which a band alignment 
     # can be applied to the whole dataset
      
-    wildCrd = "IMG_"+alIm+"*.tif"
-    algList = glob(os.path.join(imagesFolder, wildCrd))
-    #algList.sort()
-    imAl = capture.Capture.from_filelist(algList) 
-    imAl.compute_reflectance(irradiance_list=panel_irradiance)
+    rf = refBnd-1
+    
+    if alIm is None:
+        if watch is not None:
+            raise ValueError("An alignment image (alIm) is required when watching a folder")
+        candidates, scores = registration.select_alignment_captures(imgset.captures, n=n_align)
+        imAl = candidates[0]
+        print("Aligning on captures {}".format(', '.join(
+              os.path.basename(c.images[0].path)[:8] for c in candidates)))
+    else:
+        wildCrd = "IMG_"+alIm+"*.tif"
+        algList = glob(os.path.join(imagesFolder, wildCrd))
+        #algList.sort()
+        imAl = capture.Capture.from_filelist(algList) 
+    imAl.compute_reflectance(irradiance_list=panel_irradiance, n_jobs=-1)
+    
+    if watch is not None:
+        # lazily scans imagesFolder, yielding captures once all the bands of 
+        # the alignment capture are in
+        batches = imageset.ImageSet.watch(imagesFolder, idle_timeout=watch,
+                                          num_bands=len(imAl.images),
+                                          release=engine != 'pipeline')
     #imAl.plot_undistorted_reflectance(panel_irradiance)
     
-    
-    rf = refBnd-1
+    if nt is None or nt < 1:
+        width, height = imAl.images[0].size()
+        peak = utils.capture_peak_bytes(width, height, len(imAl.images))
+        processes = engine in ('joblib', 'warm')
+        # cached image products may grow to the cache budget in every worker
+        # process, while threads share the one cache of this process
+        budget = product_cache_budget()
+        if budget is None:
+            budget = peak
+        nt = utils.auto_workers(max(peak, budget) if processes else peak, nt,
+                                processes=processes, shared=0 if processes else budget)
+        print("Using {} workers".format(nt))
     
     #imAl, mx, reflFolder, rf, plots, warp_md
     
-    warp_matrices, alignment_pairs, rgb, cir, grRE = align_template(imAl, mx, reflFolder,
-                                                    rf, plots, warp_md)
+    store = registration.warp_cache(warp_cache)
+    key = registration.camera_key(imAl, warp_md, rf,
+                                  {'align_mode': align_mode, 'mx': mx, 'adaptive': adaptive,
+                                   'n_align': n_align if alIm is None else None})
+    # an explicitly chosen alignment image is always aligned
+    cached = store.get(key) if store is not None and alIm is None else None
+    if cached is not None and verify and cached['score'] is not None:
+        score = min(registration.registration_scores(imAl, cached['warp_matrices'], rf).values())
+        print("Cached band alignment scores {:.3f}, {:.3f} when stored".format(score, cached['score']))
+        if score < 0.8 * cached['score']:
+            print("Cached band alignment does not fit this flight, realigning")
+            cached = None
+    
+    if cached is not None:
+        print("Using the cached band alignment of camera {}".format(key[0]))
+        warp_matrices, alignment_pairs, rgb, cir, grRE, cropped_dimensions = align_template(imAl, mx, reflFolder,
+                                                        rf, plots, warp_md,
+                                                        warp_matrices=cached['warp_matrices'],
+                                                        adaptive=adaptive)
+    else:
+        warp_matrices = eccs = None
+        if align_mode == 'ecc' and alIm is None:
+            warp_matrices, report = registration.robust_alignment(candidates, rf, warp_md,
+                                                                  max_iterations=mx,
+                                                                  adaptive=adaptive)
+            print(registration.format_report(report))
+            eccs = [report[i]['ecc'] if i in report else None for i in range(len(imAl.images))]
+        elif align_mode != 'ecc':
+            warp_matrices, report = registration.rig_registration(imAl, rf, warp_md,
+                                                                  refine=align_mode == 'rig+ecc')
+            print(registration.format_report(report))
+            eccs = [report[i]['ecc'] if i in report else None for i in range(len(imAl.images))]
+        warp_matrices, alignment_pairs, rgb, cir, grRE, cropped_dimensions = align_template(imAl, mx, reflFolder,
+                                                        rf, plots, warp_md,
+                                                        warp_matrices=warp_matrices,
+                                                        adaptive=adaptive)
+        if alignment_pairs is not None:
+            eccs = [pair['ecc'] for pair in alignment_pairs]
     
     if plots == True:
         
@@ -263,9 +393,14 @@ def mspec_proc(imgFolder, alIm, srFolder, precal=None, postcal=None, refBnd=4,
         axes[2].imshow(grRE) 
         plt.show()
     
-    if not input("Please check the SR folder - Is the imagery correctly aligned for all bands ? (y/n): ").lower().strip()[:1] == "y": 
-        print("Run again with a different alignment image candidate")
-        sys.exit(1)
+    if cached is None:
+        if interactive and not input("Please check the SR folder - Is the imagery correctly aligned for all bands ? (y/n): ").lower().strip()[:1] == "y": 
+            print("Run again with a different alignment image candidate")
+            sys.exit(1)
+        
+        if store is not None:
+            scores = registration.registration_scores(imAl, warp_matrices, rf)
+            store.put(key, warp_matrices, min(scores.values()), eccs)
         
     del rgb, cir, grRE
     
@@ -279,10 +414,8 @@ def mspec_proc(imgFolder, alIm, srFolder, precal=None, postcal=None, refBnd=4,
         bndFolders = [os.path.join(reflFolder, b) for b in bndNames]
         [os.mkdir(bf) for bf in bndFolders]
         
-        Parallel(n_jobs=nt,
-                 verbose=2)(delayed(_proc_imgs_comp)(imCap, warp_matrices,
-                           bndFolders,
-                           panel_irradiance, warp_md, rf) for imCap in imgset.captures)
+        _run(batches, _imgs_comp, _proc_imgs_comp, engine, nt, warp_matrices,
+             cropped_dimensions, bndFolders, panel_irradiance, warp_md, rf)
 
         
 
@@ -292,23 +425,88 @@ def mspec_proc(imgFolder, alIm, srFolder, precal=None, postcal=None, refBnd=4,
         bndNames = ['Blue', 'Green', 'Red', 'NIR', 'Red edge']
         bndFolders = [os.path.join(reflFolder, b) for b in bndNames]
         [os.mkdir(bf) for bf in bndFolders]
-        Parallel(n_jobs=nt,
-                 verbose=2)(delayed(_proc_imgs)(imCap,
-                 warp_matrices,
-                 bndFolders,
-                 panel_irradiance, rf) for imCap in imgset.captures)
+        
+        _run(batches, _imgs, _proc_imgs, engine, nt, warp_matrices,
+             cropped_dimensions, bndFolders, panel_irradiance, warp_md, rf)
 
-# func to align and display the result. 
-def align_template(imAl, mx, reflFolder, rf, plots, warp_md):
+def _run(batches, compute, proc, engine, nt, *args):
+    
+    """
+    Process every capture of batches with proc(capture, *args) on joblib or
+    through the staged pipeline using compute(capture, *args) -> outputs
+    """
+    
+    if engine == 'pipeline':
+        workers = None if nt is None or nt < 1 else nt
+        stats = pipeline.run((imCap for batch in batches for imCap in batch),
+                             _read_capture,
+                             lambda imCap, _: compute(imCap, *args),
+                             _write_outputs, workers=workers)
+        print(pipeline.format_stats(stats))
+    elif engine == 'joblib':
+        for batch in batches:
+            Parallel(n_jobs=nt,
+                     verbose=2)(delayed(proc)(imCap, *args) for imCap in batch)
+    elif engine == 'threads':
+        for batch in batches:
+            Parallel(n_jobs=nt, prefer='threads',
+                     verbose=2)(delayed(proc)(imCap, *args) for imCap in batch)
+    elif engine == 'warm':
+        processes = None if nt is None or nt < 1 else nt
+        pool = multiprocessing.Pool(processes=processes, initializer=_init_warm,
+                                    initargs=(proc, args, utils.undistort_state()))
+        try:
+            for batch in batches:
+                paths = [[im.path for im in imCap.images] for imCap in batch]
+                for _ in tqdm(pool.imap_unordered(_warm_task, paths), total=len(paths)):
+                    pass
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        raise ValueError("engine must be one of 'joblib', 'threads', 'warm' or 'pipeline'")
+
+# per process state of the warm engine's workers, set once by _init_warm
+_warm = {}
+
+def _init_warm(proc, args, tables):
+    
+    """ warm worker initializer: keep the shared processing state """
+    
+    utils.load_undistort_state(tables)
+    _warm['proc'] = proc
+    _warm['args'] = args
 
+def _warm_task(paths):
+    
+    """ warm worker task: process the capture made of paths """
     
-    warp_matrices, alignment_pairs = imageutils.align_capture(imAl,
-                                                              ref_index=rf, 
-                                                              warp_mode=warp_md,
-                                                              max_iterations=mx)
+    _warm['proc'](capture.Capture.from_filelist(paths), *_warm['args'])
+    return paths
+
+# func to align and display the result. 
+def align_template(imAl, mx, reflFolder, rf, plots, warp_md, warp_matrices=None,
+                   adaptive=False):
+
+    
+    if warp_matrices is None:
+        warp_matrices, alignment_pairs = imageutils.align_capture(imAl,
+                                                                  ref_index=rf, 
+                                                                  warp_mode=warp_md,
+                                                                  max_iterations=mx,
+                                                                  adaptive=adaptive)
+        for pair in alignment_pairs:
+            if pair.get('ecc_levels'):
+                print("Band {} ECC per level: {}".format(pair['match_index'],
+                      ', '.join('{:.3f}'.format(cc) for cc in pair['ecc_levels'])))
+    else:
+        # previously found (cached) alignment
+        alignment_pairs = None
     for x,mat in enumerate(warp_matrices):
         print("Band {}:\n{}".format(x,mat))
 
+    # cropped_dimensions depends only on the warps and the camera intrinsics,
+    # so it is found once here and shared by every capture of the dataset
     # cropped_dimensions is of the form:
     # (first column with overlapping pixels present in all images, 
     #  first row with overlapping pixels present in all images, 
@@ -330,7 +528,7 @@ def align_template(imAl, mx, reflFolder, rf, plots, warp_md):
    # capture, warp_matrices, cv2.MOTION_HOMOGRAPHY, cropped_dimensions, None, img_type="reflectance",
     im_aligned = imageutils.aligned_capture(imAl, warp_matrices, warp_md,
                                             cropped_dimensions, match_index,
-                                            img_type="reflectance")
+                                            img_type="reflectance", n_jobs=-1)
     im_display = np.zeros((im_aligned.shape[0],im_aligned.shape[1],5), dtype=np.float32 )
     
     for iM in range(0,im_aligned.shape[2]):
@@ -356,136 +554,110 @@ def align_template(imAl, mx, reflFolder, rf, plots, warp_md):
             img8 = util.img_as_ubyte(imgre)
         imageio.imwrite(names[ind], img8)
     
-    return warp_matrices, alignment_pairs, rgb, cir, grRE#, dist_coeffs, cam_mats, cropped_dimensions
+    return warp_matrices, alignment_pairs, rgb, cir, grRE, cropped_dimensions#, dist_coeffs, cam_mats
    
 # prep work dir
 
 
 # Main func to  write bands to their respective directory
 
-def _proc_imgs(i, warp_matrices, bndFolders, panel_irradiance, warp_md, normalize=None):
-    
+def _read_capture(i):
     
-#    for i in imgset.captures: 
+    """ pipeline reader: load the raw pixels (and metadata) of every band """
     
-    i.compute_reflectance(irradiance_list=panel_irradiance) 
-    #i.plot_undistorted_reflectance(panel_irradiance)  
-
+    for im in i.images:
+        im.raw()
 
-    cropped_dimensions, edges = imageutils.find_crop_bounds(i, warp_matrices, warp_mode=warp_md)
+def _write_tagged(outFile, data, src, tags=None):
     
-    im_aligned = imageutils.aligned_capture(i, warp_matrices,
-                                            warp_md,
-                                            cropped_dimensions,
-                                            None, img_type="reflectance")
+    """ write data to outFile in one pass, along with the EXIF, GPS and XMP 
+    tags of src (or tags, see metadata.write_tagged) """
     
-    im_display = np.zeros((im_aligned.shape[0],im_aligned.shape[1],5), dtype=np.float32 )
+    metadata.write_tagged(outFile, data, src, tags, exiftoolPath)
+
+# per process pool of the per capture stacks and composites, an array goes
+# back to it once written so the composite path allocates nothing per capture
+_buffers = utils.BufferPool()
+
+def _write_outputs(i, outputs):
     
-    for iM in range(0,im_aligned.shape[2]):
-        im_display[:,:,iM] =  imageutils.normalize(im_aligned[:,:,iM])*65535
+    """ pipeline writer: write the (outFile, data, src) outputs of a capture """
     
-    for k in range(0,im_display.shape[2]):
-         im = i.images[k]
-         hd, nm = os.path.split(im.path)
-         outdata = im_aligned[:,:,i]
-         outdata[outdata<0] = 0
-         outdata[outdata>1] = 1
-         
-         outfile = os.path.join(bndFolders[k], nm)
-         imageio.imwrite(outfile, outdata)
-        
-         cmd = ["exiftool", "-tagsFromFile", im.path,  "-file:all", "-iptc:all",
-               "-exif:all",  "-xmp", "-Composite:all", outfile, 
-               "-overwrite_original"]
-         call(cmd)
+    tags = {}
+    for outFile, data, src in outputs:
+        if src not in tags:
+            tags[src] = metadata.source_tags(src, (data.shape[1], data.shape[0]))
+        _write_tagged(outFile, data, src, tags[src])
+    _buffers.release(*[data for _, data, _ in outputs])
+    i.clear_image_data()
 
-def _proc_imgs_comp(i, warp_matrices, bndFolders, panel_irradiance, warp_md, rf):
-    
+def _imgs(i, warp_matrices, cropped_dimensions, bndFolders, panel_irradiance, warp_md, rf):
     
+    """ single band outputs of a capture as (outFile, data, src) """
     
     i.compute_reflectance(irradiance_list=panel_irradiance) 
     #i.plot_undistorted_reflectance(panel_irradiance)  
 
-
-    cropped_dimensions, edges = imageutils.find_crop_bounds(i, warp_matrices)
     
     im_aligned = imageutils.aligned_capture(i, warp_matrices,
                                             warp_md,
                                             cropped_dimensions,
                                             match_index=rf, img_type="reflectance")
     
+    outputs = []
+    for k in range(0,im_aligned.shape[2]):
+         im = i.images[k]
+         hd, nm = os.path.split(im.path)
+         outdata = im_aligned[:,:,k]
+         outdata[outdata<0] = 0
+         outdata[outdata>1] = 1
+         
+         outputs.append((os.path.join(bndFolders[k], nm), outdata, im.path))
+    return outputs
+
+def _proc_imgs(i, warp_matrices, cropped_dimensions, bndFolders, panel_irradiance, warp_md, rf):
     
     
-    im_display = np.zeros((im_aligned.shape[0], im_aligned.shape[1], 5), dtype=np.float32)
-    
-    for iM in range(0,im_aligned.shape[2]):
-        im_display[:,:,iM] =  imageutils.normalize(im_aligned[:,:,iM])*32768
+#    for i in imgset.captures: 
     
+    _write_outputs(i, _imgs(i, warp_matrices, cropped_dimensions, bndFolders, panel_irradiance, warp_md, rf))
 
+def _imgs_comp(i, warp_matrices, cropped_dimensions, bndFolders, panel_irradiance, warp_md, rf):
     
-    rgb = im_display[:,:,[2,1,0]] 
-    #cir = im_display[:,:,[3,2,1]] 
-    RRENir = im_display[:,:,[4,3,2]] 
+    """ RGB and RRENir composites of a capture as (outFile, data, src)
     
-#    cir = im_display[:,:,[3,2,1]]
-#    
-#    grRE = im_display[:,:,[4,2,1]] 
-#    
-#    imoot = [rgb, RRENir]
+    The aligned stack, its quantized bands and the composites are recycled
+    through _buffers, the composites are handed back by _write_outputs
+    """
     
-    del im_display
+    i.compute_reflectance(irradiance_list=panel_irradiance) 
+    #i.plot_undistorted_reflectance(panel_irradiance)  
+
+    rgb, RRENir = imageutils.composites(i, warp_matrices, warp_md,
+                                        cropped_dimensions, rf, pool=_buffers)
     
-    imtags = ["RGB.tif", "RRENir.tif"]#, "GRNir.tif", "GRRE.tif"]
     im = i.images[1]
     hd, nm = os.path.split(im.path[:-6])
     
-    
+    outputs = []
+    for image, folder in zip([rgb, RRENir], bndFolders):
+        outputs.append((os.path.join(folder, nm+'.tif'), image, im.path))
+    return outputs
 
-    #cmdList = []
+def _proc_imgs_comp(i, warp_matrices, cropped_dimensions, bndFolders, panel_irradiance, warp_md, rf):
     
-    def _writeim(image, folder, nametag, im):
-    
-    #for ind, k in enumerate(bndFolders):      
-         #img8 = bytescale(imoot[ind])
-        #imgre = exposure.rescale_intensity(image,  out_range='uint16')
-     
-        #with warnings.catch_warnings():
-        #warnings.simplefilter("ignore")
-        img16 = np.uint16(np.round(image, decimals=0))
-        del image
-        outFile = os.path.join(folder, nm+'.tif')
-        #imageio.imwrite(outfile, img8)
-        
-        #imOut = Image.fromarray(img16)
-    
-        #imOut.save(outFile)
-        imageio.imwrite(outFile, img16)
-        
-        del img16
-        cmd = ["exiftool", "-tagsFromFile", im.path,  "-file:all", "-iptc:all",
-               "-exif:all",  "-xmp", "-Composite:all", outFile, 
-               "-overwrite_original"]
-        call(cmd)
-        
-        
-    
-    _writeim(rgb, bndFolders[0], imtags[0], im)
-    del rgb    
-    _writeim(RRENir, bndFolders[1], imtags[1], im)
-    del RRENir#, 
+    _write_outputs(i, _imgs_comp(i, warp_matrices, cropped_dimensions, bndFolders, panel_irradiance, warp_md, rf))
     # for ref
 #[_proc_imgs(imCap, warp_matrices, reflFolder) for imCap in imgset]
-def _proc_stack(i, warp_matrices, bndFolders, panel_irradiance, reflFolder, warp_md, rf):
+def _proc_stack(i, warp_matrices, cropped_dimensions, bndFolders, panel_irradiance, reflFolder, warp_md, rf):
     
     i.compute_reflectance(irradiance_list=panel_irradiance) 
         #i.plot_undistorted_reflectance(panel_irradiance)  
     
     
-    cropped_dimensions, edges = imageutils.find_crop_bounds(i, warp_matrices, warp_mode=warp_md)
-    
     im_aligned = imageutils.aligned_capture(i, warp_matrices,
-                                            cropped_dimensions,
                                             warp_md,
+                                            cropped_dimensions,
                                             match_index=rf, img_type="reflectance")
     
     im_display = np.zeros((im_aligned.shape[0],im_aligned.shape[1],5), 
@@ -510,7 +682,7 @@ def _proc_stack(i, warp_matrices, bndFolders, panel_irradiance, reflFolder, warp
     
     i.compute_reflectance(panel_irradiance+[0])
     
-    i.save_capture_as_reflectance_stack(filename, normalize = True)
+    i.save_capture_as_reflectance_stack(filename, normalize = True, tags_from=im)
     
 #    for i in range(0,5):
 #        outband = outRaster.GetRasterBand(i+1)
@@ -532,11 +704,7 @@ def _proc_stack(i, warp_matrices, bndFolders, panel_irradiance, reflFolder, warp
 #        outband.WriteArray(outdata)
 #        outband.FlushCache()
 #    outRaster = None
-    
-    cmd = ["exiftool", "-tagsFromFile", im,  "-file:all", "-iptc:all",
-               "-exif:all",  "-xmp", "-Composite:all", filename, 
-               "-overwrite_original"]
-    call(cmd)
+
 
 
          
@@ -733,30 +901,48 @@ def stack_rasters(inRas1, inRas2, outRas, dtype=gdal.GDT_Int32, slantr=False):
     outDataset = None
     
 
-def mica_csv(folder, time_date=False):
+def mica_csv(folder, time_date=False, index=None):
+    
+    """
+    Write the MicMac GPS log (log.csv) of a folder of MicaSense imagery
+    
+    Parameters
+    ----------
     
+    folder: string
+            directory containing the raw imagery
+    
+    time_date: bool
+            whether to flag the time stamp in the header
+    
+    index: string (optional)
+            path to a capture index (.npz, see ImageSet.save_index) - 
+            it is loaded if it exists, otherwise built and saved there
+    
+    """
     
     if time_date != False:
         header = "#F=N X Y Z GPSTimeStamp"
     else:
         header = "#F=N X Y Z"
-    lines = [header]
-    
-    imgset = imageset.ImageSet.from_directory(folder)
-
-    for cap in imgset.captures:
-    
-        lat,lon,alt = cap.location()
-        #resolution = capture.images[0].focal_plane_resolution_px_per_mm
-        impath = cap.images[0].path[:-6]
-        hd, tl  = os.path.split(impath)
-        linestr = tl+","
-        linestr += str(lon)+","
-        linestr += str(lat)+","
-        linestr += str(alt)+","    
-        linestr += capture.utc_time().strftime("%Y:%m:%d,%H:%M:%S,")
-        linestr += '\n' # when writing in text mode, the write command will convert to os.linesep
-        lines.append(linestr)
+    
+    if index is not None and os.path.isfile(index):
+        idx = imageset.ImageSet.load_index(index)
+    else:
+        imgset = imageset.ImageSet.from_directory(folder, lazy=True)
+        idx = imgset.capture_index()
+        if index is not None:
+            imgset.save_index(index)
+    
+    names = [os.path.split(p)[1][:-6] for p in idx['paths'][:, 0]]
+    times = np.datetime_as_string(idx['time'], unit='s')
+    times = np.char.replace(np.char.replace(times, '-', ':'), 'T', ',')
+    rows = np.char.add(np.char.add(idx['longitude'].astype(str), ','),
+                       np.char.add(idx['latitude'].astype(str), ','))
+    rows = np.char.add(np.char.add(rows, idx['altitude'].astype(str)), ',')
+    rows = np.char.add(np.char.add(rows, times), ',\n')
+    # when writing in text mode, the write command will convert to os.linesep
+    lines = [header] + [nm + ',' + r for nm, r in zip(names, rows.tolist())]
     
     fullCsvPath = os.path.join(folder,'log.csv')
     with open(fullCsvPath, 'w') as csvfile: #create CSV
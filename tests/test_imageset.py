@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ImageSet.update with band files of a capture arriving one after another
+"""
+import os
+import shutil
+import time
+
+import pytest
+
+from pycmac.micasense import benchmarks, imageset
+
+
+def _arrive(paths, folder):
+    # copy band files in, dated past the settle time
+    old = time.time() - 60
+    for p in paths:
+        dst = os.path.join(folder, os.path.basename(p))
+        shutil.copy(p, dst)
+        os.utime(dst, (old, old))
+
+
+@pytest.fixture
+def bands(tmp_path):
+    paths = benchmarks.make_synthetic_flight(str(tmp_path / 'card'), captures=2, size=(64, 48))
+    return sorted(paths)
+
+
+def test_partial_capture_waits_for_all_bands(tmp_path, bands):
+    folder = str(tmp_path / 'flight')
+    os.makedirs(folder)
+    imgset = imageset.ImageSet([], sort=False)
+    first, second = bands[:5], bands[5:]
+
+    _arrive(first[:3], folder)
+    assert imgset.update(folder, num_bands=5, native=True, cache=False) == []
+
+    _arrive(first[3:] + second[:2], folder)
+    added = imgset.update(folder, num_bands=5, native=True, cache=False)
+    assert [len(c.images) for c in added] == [5]
+
+    # later polls take the band count from the captures already held
+    _arrive(second[2:4], folder)
+    assert imgset.update(folder, native=True, cache=False) == []
+    _arrive(second[4:], folder)
+    added = imgset.update(folder, native=True, cache=False)
+    assert [len(c.images) for c in added] == [5]
+    assert len(imgset.captures) == 2
+
+
+def test_band_count_required_before_first_capture(tmp_path, bands):
+    folder = str(tmp_path / 'flight')
+    os.makedirs(folder)
+    _arrive(bands[:3], folder)
+    with pytest.raises(ValueError):
+        imageset.ImageSet([], sort=False).update(folder, native=True, cache=False)
@@ -0,0 +1,21 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Persistent metadata cache
+"""
+import os
+
+from pycmac.micasense import benchmarks, metadata
+
+
+def test_cache_invalidated_by_mtime(tmp_path):
+    paths = sorted(benchmarks.make_synthetic_flight(str(tmp_path / 'card'), captures=1, size=(64, 48)))
+    store = metadata.metadata_cache(str(tmp_path / 'metadata.sqlite'))
+    records = metadata.get_metadata_batch(paths, native=True, cache=store)
+    assert store.get_many(paths, native=True) == dict(zip(paths, records))
+    # records of one reader are not handed to the other
+    assert store.get_many(paths, native=False) == {}
+
+    st = os.stat(paths[0])
+    os.utime(paths[0], ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    assert set(store.get_many(paths, native=True)) == set(paths[1:])
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Native TIFF tag reading and writing of processed outputs
+"""
+import cv2
+import numpy as np
+import pytest
+
+from pycmac.micasense import benchmarks, metadata, tiffmeta
+
+
+@pytest.fixture
+def band(tmp_path):
+    paths = benchmarks.make_synthetic_flight(str(tmp_path / 'card'), captures=1, size=(64, 48))
+    return sorted(paths)[0]
+
+
+def test_records_use_exiftool_keys(band):
+    record = tiffmeta.get_metadata(band)
+    # keyed by group and tag name, as exiftool -G -n -j writes them
+    assert all(k == 'SourceFile' or k.split(':')[0] in ('EXIF', 'XMP') for k in record)
+    assert {'EXIF:ExposureTime', 'XMP:CaptureId', 'XMP:RigRelatives'} <= set(metadata.compact_record(record))
+    assert record['SourceFile'] == band
+    assert record['EXIF:Make'] == 'MicaSense'
+    assert record['XMP:BandName'] == 'Blue'
+    assert record['XMP:CentralWavelength'] == 475
+    assert record['EXIF:GPSLatitudeRef'] == 'N'
+    assert record['EXIF:GPSLatitude'] == pytest.approx(55 + 51 / 60. + 30.14 / 3600)
+    # exiftool only writes values that read back as the same JSON number as numbers
+    assert record['EXIF:SubSecTime'] == '000000'
+    assert isinstance(record['XMP:RadiometricCalibration'], list)
+    assert metadata.Metadata(band, exif=record).band_name() == 'Blue'
+
+
+@pytest.mark.parametrize('dtype, shape', [(np.uint16, (24, 32)), (np.float32, (24, 32, 2))])
+def test_write_tiff_round_trip(tmp_path, dtype, shape):
+    path = str(tmp_path / 'out.tif')
+    data = np.arange(np.prod(shape), dtype=dtype).reshape(shape)
+    ifd0 = {271: (2, 'MicaSense'), 305: (2, 'pycmac')}
+    exif = {33434: (5, ((1, 1000),)), 42033: (2, '0123456')}
+    gps = {1: (2, 'N'), 2: (5, ((55, 1), (51, 1), (3014, 100)))}
+    xmp = b'<x:xmpmeta xmlns:x="adobe:ns:meta/"></x:xmpmeta>'
+    tiffmeta.write_tiff(path, data, ifd0=ifd0, exif=exif, gps=gps, xmp=xmp)
+
+    tags = tiffmeta.read_tiff_tags(path)
+    for tag, value in ifd0.items():
+        assert tags['IFD0'][tag] == value
+    assert tags['IFD0'][tiffmeta.XMP_TAG][1] == xmp
+    assert tags['ExifIFD'] == exif
+    assert tags['GPS'] == gps
+    assert (tags['IFD0'][256][1][0], tags['IFD0'][257][1][0]) == (shape[1], shape[0])
+    with open(path, 'rb') as fh:
+        fh.seek(tags['IFD0'][273][1][0])
+        pixels = np.frombuffer(fh.read(tags['IFD0'][279][1][0]), dtype=dtype)
+    assert np.array_equal(pixels.reshape(shape), data)
+
+
+def test_output_round_trip(tmp_path, band):
+    out = str(tmp_path / 'out.tif')
+    data = np.arange(32 * 24 * 3, dtype=np.uint8).reshape(24, 32, 3)
+    metadata.write_tagged(out, data, band)
+
+    src, dst = tiffmeta.get_metadata(band), tiffmeta.get_metadata(out)
+    for key in ('EXIF:Make', 'EXIF:Model', 'EXIF:GPSLatitude', 'EXIF:GPSLongitude',
+                'EXIF:FocalLength', 'XMP:CaptureId', 'XMP:BandName'):
+        assert dst[key] == src[key]
+    assert (dst['EXIF:ImageWidth'], dst['EXIF:ImageHeight']) == (32, 24)
+
+    assert np.array_equal(cv2.imread(out, -1)[..., ::-1], data)
+
+
+def test_output_tags_skip_source_encoding(tmp_path, band):
+    tags = tiffmeta.output_tags(band)
+    src = str(tmp_path / 'palette.tif')
+    ifd0 = dict(tags['ifd0'])
+    # ColorMap, JPEGTables, YCbCrCoefficients
+    ifd0.update({320: (3, (0,) * 768), 347: (7, b'\xff\xd8\xff\xd9'), 529: (5, ((299, 1000),) * 3)})
+    tiffmeta.write_tiff(src, np.zeros((8, 8), np.uint8), ifd0=ifd0, exif=tags['exif'],
+                        gps=tags['gps'], xmp=tags['xmp'])
+
+    copied = tiffmeta.output_tags(src)
+    assert not set(copied['ifd0']) & {320, 347, 529}
+    assert copied['ifd0'][271] == tags['ifd0'][271]